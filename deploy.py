@@ -24,7 +24,11 @@ import sys
 import time
 import logging
 import uuid
+import copy
+import json
 import urllib2
+import threading
+import tempfile
 import yaml
 from argparse import ArgumentParser, FileType
 from distutils.core import run_setup
@@ -32,15 +36,19 @@ from sys import exit
 from hashlib import sha1
 from os import environ
 from os.path import basename
-import boto3
 from setuptools import setup, find_packages
 from functools import partial
 from contextlib import closing
+from multiprocessing.pool import ThreadPool
 from time import strftime
-from pprint import pprint
-from boto3.s3.transfer import S3Transfer
-from botocore.exceptions import ClientError
-from deploylib import DeployLib
+from botocore.exceptions import ClientError, HTTPClientError, ConnectionError as BotoConnectionError
+from deploylib import DeployLib, DeployException, PreDeployHookRunner, HookResult, StaticDeployJournal, file_sha256
+from deployconfig import DeployConfig
+from deployaws import ClientPool, RateLimiter, MultipartUploadStream, UploadScheduler, call_with_retries, plan_delta_parts, upload_delta, upload_hashed, verify_uploads
+from deploycfn import StackParameterPlan, describe_stack, get_template_parameters, is_no_op_update
+from deploybuild import get_sdist_files, write_release_archive
+from deploystatic import ContentAddressedLayout, dump_manifest, MANIFEST_VERSION
+from deploymetrics import ApiMetrics, Tracer, traced
 
 logging.basicConfig(level=logging.INFO)
 
@@ -115,55 +123,69 @@ class AppDeployer(object):
         '.svg': 'image/svg+xml',
         '.gif': 'image/gif',
         '.ico': 'image/x-icon',
-        '.css': 'text/css'
+        '.css': 'text/css',
+        '.html': 'text/html',
+        '.json': 'application/json'
     }
+
+    DEFAULT_CACHE_CONTROL = 'max-age=604801'
+    # A rollback touching more paths than this invalidates /* instead
+    MAX_INVALIDATION_PATHS = 100
+    POOL_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+    MANIFEST_CACHE_CONTROL = 'max-age=300'
+
+    # setup() builds in the current directory and isn't thread safe, so
+    # deploys sharing a process (the daemon) take turns building
+    BUILD_LOCK = threading.Lock()
+
     
     def __init__(self, dry_run, verbose,
                  config_path, deploy_app,
                  template, template_url, parameters,
                  product, stamp, blessed, stack_name,
                  no_db_migrations, db_migrator, no_static, static_src_root,
-                 update_distro, change_cloudfront_origin):
+                 update_distro, change_cloudfront_origin, force_db_migrations=False,
+                 resume=False, trace_out=None, wait=False, wait_timeout=600, warm=None):
         
         self.stack_name = stack_name
+        self.trace_out = trace_out
+        self.tracer = Tracer(enabled=bool(trace_out))
+        # Caches and client pools kept across deploys by deployd, if any
+        self.warm = warm
         
-        if os.path.exists(config_path) and os.path.isfile(config_path):
-            try:
-                with open(config_path, 'rb') as f:
-                    self.deploy_configs = yaml.load(f)
-            except Exception, ex:
-                import traceback
-                raise Exception("Config path %s could not be loaded beacuse: %s" % (config_path, traceback.format_exc()))
+        with self.tracer.span('config.load'):
+            self.config = DeployConfig.load(config_path, self.stack_name,
+                                            cache=warm.config_cache if warm else None)
+        self.deploy_configs = self.config.raw
+        self.stack_vars = self.config.stack_vars
+        self.rate_limiter = RateLimiter(self.config.rate_limits)
+        self.api_metrics = ApiMetrics()
+        # The rate limiter goes first so its waits aren't counted as latency
+        observers = [self.rate_limiter, self.api_metrics, self.tracer]
+        if warm:
+            self.aws = warm.checkout_client_pool(self.config, observers)
         else:
-            raise Exception("Config path %s is not valid" % config_path)
-
-        ### Load stack-specific vars
-        if 'stack-vars-root' in self.deploy_configs:
-            stack_vars_root_path = self.deploy_configs['stack-vars-root']
-            stack_vars_path = os.path.join(stack_vars_root_path, "%s-deploy.yaml" % self.stack_name)
-            if os.path.exists(stack_vars_path):
-                with open(stack_vars_path, "rb") as f:
-                    conf_dict = yaml.load(f)
-                    self.stack_vars = conf_dict['%s-vars' % self.stack_name]
-            else:
-                logging.warn("Could not find path for stack-specific variables: %s" % stack_vars_path)
-                self.stack_vars = {}
-        else:
-            self.stack_vars = {}
+            self.aws = ClientPool(max_workers=self.config.upload_workers,
+                                  region_name=self.config.aws_region,
+                                  observers=observers)
+        self.dist_index = warm.dist_index if warm else {}
+        self.hash_index = warm.hash_index if warm else None
         
         self.pre_deploy_hooks = {}
+        self.pre_deploy_hooks_ran = False
         
         if 'pre-deploy-hook-root' in self.deploy_configs:
             if 'pre-deploy-hooks' in self.deploy_configs:
                 import importlib
                 hook_root = self.deploy_configs['pre-deploy-hook-root']
-                sys.path.append(hook_root)
+                if hook_root not in sys.path:
+                    sys.path.append(hook_root)
                 
                 hooks = self.deploy_configs['pre-deploy-hooks']
                 for hook_name, hook_details in hooks.items():
                     hook_file = hook_details['hook-file']
                     hook_class = hook_details['hook-class']
-                    hook_params = hook_details['params']
+                    hook_params = hook_details.get('params', {})
                     
                     try:
                         hook_mod = importlib.import_module(hook_file.replace(".py", ""))
@@ -171,10 +193,13 @@ class AppDeployer(object):
                             hook_cls = getattr(hook_mod, hook_class)
                             self.pre_deploy_hooks[hook_name] = {
                                 'cls': hook_cls,
-                                'params': hook_params
+                                'params': hook_params,
+                                'depends-on': hook_details.get('depends-on', []),
+                                'timeout': hook_details.get('timeout'),
+                                'required': hook_details.get('required', False)
                             }
                         except AttributeError, ex:
-                            logging.error("Unable to find hook class %s in hook module %s, skipping." % (hook_cls, hook_mod))
+                            logging.error("Unable to find hook class %s in hook module %s, skipping." % (hook_class, hook_mod))
                     except ImportError, ex:
                         logging.error("Unable to import hook module %s, skipping." % hook_file)
 
@@ -189,8 +214,7 @@ class AppDeployer(object):
         if not no_db_migrations:
             self.db_migrator = db_migrator
             if not self.db_migrator:
-                if 'db-migrator' in self.deploy_configs:
-                    self.db_migrator = self.deploy_configs['db-migrator']
+                self.db_migrator = self.config.db_migrator
         else:
             self.db_migrator = None
         self.product = product
@@ -200,13 +224,11 @@ class AppDeployer(object):
         self.no_static = no_static
         
         if static_src_root:
-            self.static_src_root = static_src_root
-        else:
-            if 'static-src-root' in self.deploy_configs:
-                self.static_src_root = self.deploy_configs['static-src-root']
-            else:
-                logging.warn("No static src root specified, cannot do static deploy.".upper())
-                self.no_static = True
+            self.config.set_static_src_root(static_src_root)
+        self.static_src_root = self.config.static_src_root
+        if not self.static_src_root:
+            logging.warn("No static src root specified, cannot do static deploy.".upper())
+            self.no_static = True
 
         """
         Allowable combinations:
@@ -222,19 +244,79 @@ class AppDeployer(object):
             self.update_distro = False
             self.revert_distro = change_cloudfront_origin
         
-        self.deploy_lib = DeployLib(self.product, self.db_migrator)
-        (self.release_id, self.pkg_name, self.pkg_ver) = \
-            self.deploy_lib.gen_release_id(self.stack_name, self.stamp, is_blessed=self.blessed)
+        self.force_db_migrations = force_db_migrations
+        self.wait = wait
+        self.wait_timeout = wait_timeout
+        self.deploy_lib = DeployLib(self.product, self.db_migrator,
+                                    migrator_options=self.get_migrator_options(),
+                                    git_cache=warm.git_cache if warm else None)
+        if self.revert_distro:
+            # A rollback only ever deals with an existing release, don't ask git
+            (self.release_id, self.pkg_name, self.pkg_ver) = (self.revert_distro, None, None)
+        else:
+            with self.tracer.span('gen_release_id'):
+                (self.release_id, self.pkg_name, self.pkg_ver) = \
+                    self.deploy_lib.gen_release_id(self.stack_name, self.stamp, is_blessed=self.blessed)
+        
+        self.resume = resume
+        self.static_journal = None
+        self.upload_results = []
+        # Sends static files to the replicas while a run_static_uploads is on
+        self.replica_pool = None
+        self.pending_manifest = None
+        if self.resume:
+            self.resume_release()
+        
         if self.update_distro:
             self.static_versioning = sha1(self.release_id).hexdigest()[:10]
     
+    def close(self):
+        if self.warm:
+            self.warm.checkin_client_pool(self.config, self.aws)
+
+    def get_deploy_cache_root(self):
+        return self.config.cache_root
+
+    def get_static_journal_dir(self):
+        return os.path.join(self.get_deploy_cache_root(), 'journal', self.stack_name)
+
+    def resume_release(self):
+        journal = StaticDeployJournal.find_incomplete(self.get_static_journal_dir())
+        if journal is None:
+            raise DeployException("No interrupted static deploy found for stack %s, nothing to resume." % self.stack_name)
+        
+        if journal.release_id != self.release_id:
+            # Rebuild the release id from the interrupted deploy's stamp, which
+            # only gives the same id if we're still on the same branch/commit.
+            (release_id, pkg_name, pkg_ver) = \
+                self.deploy_lib.gen_release_id(self.stack_name, journal.stamp, is_blessed=journal.blessed)
+            if release_id != journal.release_id:
+                raise DeployException("Cannot resume release %s, the working tree now gives release id %s." % (
+                    journal.release_id, release_id))
+            (self.release_id, self.pkg_name, self.pkg_ver) = (release_id, pkg_name, pkg_ver)
+            self.stamp = journal.stamp
+            self.blessed = journal.blessed
+        
+        logging.info("Resuming static deploy of release %s, %s files already uploaded." % (
+            self.release_id, len(journal.entries)))
+
+    def get_migrator_options(self):
+        options = {}
+        if 'db-migrator-timeout' in self.deploy_configs:
+            options['timeout'] = int(self.deploy_configs['db-migrator-timeout'])
+        if 'db-migrator-watch-paths' in self.deploy_configs:
+            options['watch_paths'] = self.deploy_configs['db-migrator-watch-paths']
+        if not self.force_db_migrations:
+            options['state_path'] = os.path.join(self.get_deploy_cache_root(), 'db-migrator.sha1')
+        return options
+
     def get_app_bucket_name(self):
         # return "%s-%s" % (self.stack_name, self.APP_DEST_BUCKET_SUFFIX)
-        return self.deploy_configs['app-bucket-format'] % {'stack_name': self.stack_name}
+        return self.config.app_bucket_name
     
     def get_static_bucket_name(self):
         # return "%s-%s" % (self.STATIC_DEST_BUCKET_PREFIX, self.stack_name)
-        return self.deploy_configs['static-bucket-format'] % {'stack_name': self.stack_name}
+        return self.config.static_bucket_name
     
     def get_mime_type(self, path):
         basename, ext = os.path.splitext(path)
@@ -265,7 +347,21 @@ class AppDeployer(object):
         # 1. Get all distributions
         # 2. Find one whose origin starts with 'arm-static-<stack>'
         origin_prefix = bucket_name
-        cf = boto3.client('cloudfront')
+        cf = self.aws.client('cloudfront')
+        
+        # Skip the scan when we already know the distribution, as long as it
+        # still points at the bucket
+        if bucket_name in self.dist_index:
+            try:
+                distro = cf.get_distribution(Id=self.dist_index[bucket_name])
+                first_origin = self.get_distro_property(distro, 'Distribution', 'DistributionConfig',
+                                                        'Origins', 'Items', 0)
+                if first_origin and first_origin['DomainName'].startswith(origin_prefix):
+                    return distro
+            except ClientError, ex:
+                if ex.response['Error']['Code'] != 'NoSuchDistribution':
+                    raise
+            del self.dist_index[bucket_name]
     
         dist_dict = cf.list_distributions()
         if 'DistributionList' in dist_dict:
@@ -278,32 +374,114 @@ class AppDeployer(object):
                                 first_origin = d['Origins']['Items'][0]
                                 domain_name = first_origin['DomainName']
                                 if domain_name.startswith(origin_prefix):
-                                    return cf.get_distribution(Id=dist_id)
+                                    self.dist_index[bucket_name] = dist_id
+                                    distro = cf.get_distribution(Id=dist_id)
+                                    self.write_cached_distribution(distro)
+                                    return distro
         return None
+
+    def get_distribution_cache_path(self):
+        return os.path.join(self.get_deploy_cache_root(), 'cloudfront', "%s.json" % self.stack_name)
+
+    def read_cached_distribution(self):
+        """
+        The distribution config and ETag we last saw or wrote, so a rollback
+        can go straight to update_distribution. Returns None if there's no
+        usable entry.
+        """
+        try:
+            with open(self.get_distribution_cache_path(), 'r') as f:
+                cached = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if cached.get('bucket') != self.get_static_bucket_name():
+            return None
+        return {'Distribution': cached['Distribution'], 'ETag': cached['ETag']}
+
+    def write_cached_distribution(self, distro):
+        path = self.get_distribution_cache_path()
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            dist = distro['Distribution']
+            with open(path, 'w') as f:
+                json.dump({
+                    'bucket': self.get_static_bucket_name(),
+                    'ETag': distro['ETag'],
+                    'Distribution': {'Id': dist['Id'], 'DomainName': dist.get('DomainName'),
+                                     'DistributionConfig': dist['DistributionConfig']}
+                }, f)
+        except (IOError, OSError, TypeError), ex:
+            logging.warn("Unable to cache distribution for stack %s: %s" % (self.stack_name, ex))
+
+    def get_app_chunks_path(self):
+        return os.path.join(self.get_deploy_cache_root(), 'app-chunks', "%s.json" % self.stack_name)
+
+    def read_app_chunks(self):
+        """
+        Where the last app archive for this stack went and its chunks, or
+        None if there isn't one we can copy from.
+        """
+        try:
+            with open(self.get_app_chunks_path(), 'r') as f:
+                cached = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if cached.get('bucket') != self.get_app_bucket_name():
+            return None
+        return cached
+
+    def write_app_chunks(self, result, chunks):
+        path = self.get_app_chunks_path()
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                json.dump({'bucket': result.bucket_name, 'key': result.key, 'etag': result.etag,
+                           'size': result.size, 'sha256': result.sha256, 'chunks': chunks}, f)
+        except (IOError, OSError), ex:
+            logging.warn("Unable to record app archive chunks for stack %s: %s" % (self.stack_name, ex))
+
+    def clear_cached_distribution(self):
+        try:
+            os.unlink(self.get_distribution_cache_path())
+        except OSError:
+            pass
     
+    @traced('exec_pre_deploy_hooks')
     def exec_pre_deploy_hooks(self):
-        if self.pre_deploy_hooks:
-            for hook_name, hook_details in self.pre_deploy_hooks.items():
-                cls = hook_details['cls']
-                params = hook_details['params']
-                
-                # Attempt to instantiate hook class passing self
-                try:
-                    hook_obj = cls(self)
-                    
-                    try:
-                        # Attempt to run hook obj
-                        hook_obj.run(params)
-                    except:
-                        logging.exception("Exception running hook")
-                except:
-                    logging.exception("Problem instantiating hook class %s, skipping execution." % cls)
-                pass
-        else:
+        # Both deploy_static and deploy_application call this, only run once
+        if self.pre_deploy_hooks_ran:
+            return True
+        self.pre_deploy_hooks_ran = True
+        
+        if not self.pre_deploy_hooks:
             logging.info("No pre-deploy hooks specified!")
+            return True
+        
+        if self.dry_run:
+            msg = "Would run pre-deploy hooks [%s], but in dry run mode." % ", ".join(sorted(self.pre_deploy_hooks))
+            logging.info(msg)
+            return True
+        
+        runner = PreDeployHookRunner(self.pre_deploy_hooks, self,
+                                     default_timeout=self.deploy_configs.get('pre-deploy-hook-timeout'))
+        results = runner.run()
+        
+        failed_required = [name for name, result in results.items()
+                           if result.status != HookResult.OK and self.pre_deploy_hooks[name]['required']]
+        if failed_required:
+            logging.error("Required pre-deploy hooks did not succeed: %s" % ", ".join(sorted(failed_required)))
+            return False
+        return True
 
+    @traced('build')
     def build(self):
-        setup_params = self.deploy_configs['setup-parameters']
+        with self.BUILD_LOCK:
+            return self._build()
+
+    def get_setup_kwargs(self):
+        setup_params = self.config.setup_parameters
         
         if 'search-path-exclusions' in setup_params:
             search_exclusions = setup_params['search-path-exclusions']
@@ -315,9 +493,7 @@ class AppDeployer(object):
         else:
             console_scripts_formatted = []
         
-        dist = setup(
-            script_name = "setup.py",
-            script_args = ["sdist"],
+        return dict(
             name = self.pkg_name,
             version = self.pkg_ver,
             author = setup_params['author-name'],
@@ -330,6 +506,13 @@ class AppDeployer(object):
                 "console_scripts": console_scripts_formatted
             },
         )
+
+    def _build(self):
+        dist = setup(
+            script_name = "setup.py",
+            script_args = ["sdist"],
+            **self.get_setup_kwargs()
+        )
         
         for filetype, _, filename in dist.dist_files:
            if filetype == "sdist": return filename
@@ -338,11 +521,11 @@ class AppDeployer(object):
         encoded_fname = basename(filename)
         if url_encode:
             encoded_fname = urllib2.quote(basename(filename))
-        return "/".join([self.deploy_configs['app-releases-path'], encoded_fname])  
+        return "/".join([self.config.app_releases_path, encoded_fname])
         # return "/".join([self.APP_DEST_PATH, encoded_fname])
     
     def make_template_s3_key(self, filename, url_encode=False):
-        return "/".join([self.deploy_configs['cfn-template-releases-path'], "_".join([self.release_id, basename(filename)])])
+        return "/".join([self.config.template_releases_path, "_".join([self.release_id, basename(filename)])])
         # return "/".join([self.TEMPLATE_DEST_PATH, "_".join([self.release_id, basename(filename)])])
     
     def make_static_s3_key(self, filename, url_encode=False):
@@ -365,22 +548,100 @@ class AppDeployer(object):
         return keyname
     
     def get_static_prefix(self):
-        prefix = None
-        if 'static-prefix' in self.deploy_configs:
-            prefix = self.deploy_configs['static-prefix']
-        return prefix
+        return self.config.static_prefix
+
+    def get_static_targets(self):
+        return self.config.static_targets
+
+    def get_static_upload_workers(self):
+        # Each check goes to one region, so scale the workers with the regions
+        # to keep as many in flight per region
+        return self.config.upload_workers * len(self.get_static_targets())
+
+    def get_upload_tuning_path(self):
+        return os.path.join(self.get_deploy_cache_root(), 'upload-tuning', "%s.json" % self.stack_name)
+
+    def read_upload_tuning(self):
+        """
+        The concurrency the last static deploy of this stack settled on for
+        each size class, or None if it went to a different set of buckets.
+        """
+        try:
+            with open(self.get_upload_tuning_path(), 'r') as f:
+                tuning = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if tuning.get('buckets') != [b for _, b in self.get_static_targets()]:
+            return None
+        if not isinstance(tuning.get('workers'), dict):
+            return None
+        return tuning
+
+    def write_upload_tuning(self, settings):
+        path = self.get_upload_tuning_path()
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                json.dump(dict(settings, buckets=[b for _, b in self.get_static_targets()],
+                               release_id=self.release_id), f)
+        except (IOError, OSError), ex:
+            logging.warn("Unable to record upload settings for stack %s: %s" % (self.stack_name, ex))
+
+    @traced('static.upload')
+    def run_static_uploads(self, fn, items, size_of):
+        """
+        Calls fn on every item through an UploadScheduler, starting from the
+        concurrency the last deploy settled on.
+        """
+        tuning = self.read_upload_tuning() if self.config.upload_autotune else None
+        scheduler = UploadScheduler(
+            # A file goes to every region at once, so a slot is a request per
+            # region, and no more than each region's connection pool holds
+            max_workers=self.aws.pool_connections,
+            workers=self.config.upload_workers,
+            class_workers=tuning['workers'] if tuning else None,
+            adaptive=self.config.upload_autotune)
+        replicas = len(self.get_static_targets()) - 1
+        if replicas:
+            # Each file in flight has a task per replica on here
+            self.replica_pool = ThreadPool(self.aws.pool_connections * replicas)
+        try:
+            scheduler.run(fn, items, size_of)
+        finally:
+            scheduler.log_summary("Static uploads")
+            if self.replica_pool is not None:
+                self.replica_pool.terminate()
+                self.replica_pool = None
+        
+        settings = scheduler.get_settings()
+        if settings and self.config.upload_autotune and not self.dry_run:
+            self.write_upload_tuning(settings)
     
 
-    def upload(self, bucket_name, filename, content_type, key_maker):
-        client = boto3.client('s3')
-        transfer = S3Transfer(client)
+    def upload_file(self, bucket_name, filename, keyname, content_type, cache_control=DEFAULT_CACHE_CONTROL, body=None,
+                    targets=None, digests=None):
+        """
+        Uploads to bucket_name, or to every (region, bucket name) in targets
+        when given. digests are the content's (md5, sha256), if known.
+        Returns the result for the first bucket.
+        """
+        logging.info("About to upload file to S3 with key: %s" % keyname)
         
+        targets = targets or [(None, bucket_name)]
+        with self.tracer.span('upload_file', key=keyname, buckets=len(targets)):
+            results = upload_hashed([(self.aws.client('s3', region_name=region), target_bucket)
+                                     for region, target_bucket in targets],
+                                    keyname, filename=filename, body=body, digests=digests, pool=self.replica_pool,
+                                    extra_args={'ContentType': content_type, 'CacheControl': cache_control})
+        self.upload_results.extend(results)
+        return results[0]
+
+    def upload(self, bucket_name, filename, content_type, key_maker, cache_control=DEFAULT_CACHE_CONTROL):
         url_encoded_keyname = key_maker(filename, url_encode=True)
         raw_keyname = key_maker(filename, url_encode=False)
         
-        logging.info("About to upload file to S3 with key: %s" % raw_keyname)
-
-        transfer.upload_file(filename, bucket_name, raw_keyname, extra_args={'ContentType': content_type, 'CacheControl': 'max-age=604801'})
+        self.upload_file(bucket_name, filename, raw_keyname, content_type, cache_control)
         
         ret_url = "".join(["http://", bucket_name, ".s3.amazonaws.com/", url_encoded_keyname])
 
@@ -391,12 +652,116 @@ class AppDeployer(object):
 
         return ret_url
     
+    @traced('upload_app')
     def upload_app(self, filename):
         bucket_name = self.get_app_bucket_name()
         return self.upload(bucket_name, filename,
                            content_type='application/octet-stream',
                            key_maker=self.make_app_s3_key)
     
+    @traced('build_and_upload_app')
+    def build_and_upload_app(self):
+        """
+        The parallel build backend: writes the release archive straight into
+        a multipart upload, with no tarball in dist/. Returns its URL.
+        """
+        if self.config.app_delta_upload:
+            return self.build_and_upload_app_delta()
+        
+        bucket_name = self.get_app_bucket_name()
+        # Only egg_info needs the lock, compressing and uploading can overlap
+        # with other deploys
+        with self.BUILD_LOCK:
+            # setuptools normalizes the version, so the name (and key) has to come from egg_info
+            (fullname, files, metadata) = get_sdist_files(self.get_setup_kwargs())
+        filename = "%s.tar.gz" % fullname
+        keyname = self.make_app_s3_key(filename)
+        
+        # In a dry run there are no targets, the archive is only hashed
+        targets = [] if self.dry_run else [(self.aws.client('s3'), bucket_name)]
+        stream = MultipartUploadStream(targets, keyname,
+                                       extra_args={'ContentType': 'application/octet-stream',
+                                                   'CacheControl': self.DEFAULT_CACHE_CONTROL})
+        try:
+            write_release_archive(stream, fullname, files, metadata,
+                                  workers=self.config.build_compress_workers,
+                                  level=self.config.build_compress_level)
+        except:
+            stream.abort()
+            raise
+        
+        if self.dry_run:
+            stream.abort()
+            logging.info("Would upload %s (%s bytes, sha256 %s) to s3://%s/%s, but in dry run mode." % (
+                filename, stream.size, stream.sha256.hexdigest(), bucket_name, keyname))
+            return None
+        
+        results = stream.close()
+        self.upload_results.extend(results)
+        url = "".join(["http://", bucket_name, ".s3.amazonaws.com/", self.make_app_s3_key(filename, url_encode=True)])
+        logging.info("Uploaded %s (%s bytes, sha256 %s) to [%s]" % (filename, stream.size, results[0].sha256, url))
+        return url
+
+    def build_and_upload_app_delta(self):
+        """
+        Builds a chunked archive into a temp file and sends only the chunks
+        the last upload for this stack doesn't have, the rest are copied
+        from it server-side.
+        """
+        bucket_name = self.get_app_bucket_name()
+        archive = tempfile.NamedTemporaryFile(suffix='.tar.gz')
+        try:
+            with self.BUILD_LOCK:
+                (fullname, files, metadata) = get_sdist_files(self.get_setup_kwargs())
+            # No version in the top-level directory, so unchanged files'
+            # headers stay the same from one release to the next
+            chunks = write_release_archive(archive, fullname, files, metadata,
+                                           workers=self.config.build_compress_workers,
+                                           level=self.config.build_compress_level,
+                                           chunked=True, base_dir=self.pkg_name)
+            archive.flush()
+            filename = "%s.tar.gz" % fullname
+            keyname = self.make_app_s3_key(filename)
+            size = sum(c['size'] for c in chunks)
+            
+            previous = self.read_app_chunks()
+            parts = plan_delta_parts(chunks, previous['chunks']) if previous else []
+            copied = sum(p.size for p in parts if p.kind == 'copy')
+            if previous:
+                logging.info("%s: %s of %s bytes can be copied from %s" % (filename, copied, size, previous['key']))
+            
+            if self.dry_run:
+                logging.info("Would upload %s of %s bytes to s3://%s/%s, but in dry run mode." % (
+                    size - copied, size, bucket_name, keyname))
+                return None
+            
+            client = self.aws.client('s3')
+            extra_args = {'ContentType': 'application/octet-stream', 'CacheControl': self.DEFAULT_CACHE_CONTROL}
+            results = None
+            sent = size
+            if copied:
+                try:
+                    results = [upload_delta(client, bucket_name, keyname, archive.name, parts,
+                                            previous['key'], previous['etag'], extra_args,
+                                            part_workers=self.config.upload_workers)]
+                    sent = size - copied
+                except ClientError, ex:
+                    # Most likely the last archive was replaced or deleted since
+                    logging.warn("Delta upload of %s failed, uploading all of it: %s" % (filename, ex))
+            if results is None:
+                results = upload_hashed([(client, bucket_name)], keyname, filename=archive.name,
+                                        extra_args=extra_args)
+            self.write_app_chunks(results[0], chunks)
+        finally:
+            archive.close()
+        
+        self.upload_results.extend(results)
+        url = "".join(["http://", bucket_name, ".s3.amazonaws.com/", self.make_app_s3_key(filename, url_encode=True)])
+        logging.info("Uploaded %s (%s bytes, %s sent, sha256 %s) to [%s]" % (
+            filename, size, sent, results[0].sha256, url))
+        return url
+
+    @traced('upload_template')
     def upload_template(self, filename):
         bucket_name = self.get_app_bucket_name()
         return self.upload(bucket_name, filename,
@@ -424,8 +789,217 @@ class AppDeployer(object):
             bucket_name = self.get_static_bucket_name()
             
             if content_type:
-                self.upload(bucket_name, src_path, content_type, key_maker=self.make_static_s3_key)
+                # Only files a resumed deploy already uploaded get read twice
+                if self.static_journal and keyname in self.static_journal.entries:
+                    if self.static_journal.is_done(keyname, self.get_file_sha256(src_path)):
+                        return
+                
+                result = self.upload_file(bucket_name, src_path, keyname, content_type,
+                                          targets=self.get_static_targets())
+                
+                if self.static_journal:
+                    self.static_journal.record(keyname, result.sha256, result.size)
+        
+    def get_file_sha256(self, path):
+        if self.hash_index is not None:
+            return self.hash_index.sha256(path)
+        return file_sha256(path)
+
+    def make_static_release_key(self, rel_path):
+        return "/".join([p for p in [self.release_id, self.get_static_prefix(), rel_path] if p])
+
+    def list_keys(self, bucket_name, prefix, region_name=None):
+        keys = set()
+        paginator = self.aws.client('s3', region_name=region_name).get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                keys.add(obj['Key'])
+        return keys
+
+    def get_static_layout(self):
+        return ContentAddressedLayout(self.static_src_root, self.get_static_prefix(),
+                                      pool_dir=self.config.static_pool_dir,
+                                      stable_names=self.config.static_stable_names,
+                                      hash_index=self.hash_index)
+
+    def upload_static_asset(self, targets, asset, keyname, cache_control):
+        if self.static_journal and self.static_journal.is_done(keyname, asset.sha256):
+            return
+        
+        # The asset is already in the manifest and other assets may point at
+        # its pool key, so it has to be uploaded whatever its type
+        try:
+            content_type = self.get_mime_type(asset.path)
+        except:
+            logging.warn("Mime type of [%s] could not be determined, uploading it as application/octet-stream." % asset.path)
+            content_type = 'application/octet-stream'
+        
+        # Assets whose references were rewritten are sent from memory, and
+        # the plan already hashed every asset
+        result = self.upload_file(None, asset.path, keyname, content_type, cache_control, body=asset.content,
+                                  targets=targets, digests=(asset.digest, asset.sha256))
+        
+        if self.static_journal:
+            self.static_journal.record(keyname, result.sha256, result.size)
+
+    def get_integrity_report_path(self):
+        return os.path.join(self.get_deploy_cache_root(), 'reports', self.stack_name,
+                            "%s.integrity.json" % self.release_id)
+
+    def get_api_metrics_path(self):
+        return os.path.join(self.get_deploy_cache_root(), 'reports', self.stack_name,
+                            "%s.api-metrics.json" % self.release_id)
+
+    def write_trace(self):
+        if not self.trace_out:
+            return
+        try:
+            self.tracer.write(self.trace_out)
+            logging.info("Trace written to %s, open it in chrome://tracing or ui.perfetto.dev" % self.trace_out)
+        except (IOError, OSError), ex:
+            logging.warn("Unable to write trace to %s: %s" % (self.trace_out, ex))
+
+    def write_api_metrics(self):
+        self.rate_limiter.log_counters()
+        self.api_metrics.log_summary()
+        try:
+            path = self.get_api_metrics_path()
+            self.api_metrics.write_json(path, extra={'stack_name': self.stack_name,
+                                                     'release_id': self.release_id,
+                                                     'rate_limits': self.rate_limiter.get_counters()})
+            logging.info("AWS API metrics written to %s" % path)
+            if self.config.metrics_textfile:
+                self.api_metrics.write_prometheus(self.config.metrics_textfile,
+                                                  labels={'stack': self.stack_name})
+        except (IOError, OSError), ex:
+            logging.warn("Unable to write AWS API metrics: %s" % ex)
+
+    @traced('verify_static_release')
+    def verify_static_release(self):
+        bucket_names = [b for _, b in self.get_static_targets()]
+        results = verify_uploads(self.aws, [r for r in self.upload_results if r.bucket_name in bucket_names],
+                                 self.get_static_upload_workers())
+        failed = [r for r in results if not r.verified]
+        
+        report_path = self.get_integrity_report_path()
+        if not os.path.isdir(os.path.dirname(report_path)):
+            os.makedirs(os.path.dirname(report_path))
+        with open(report_path, 'w') as f:
+            json.dump({
+                'release_id': self.release_id,
+                'buckets': bucket_names,
+                'checked': len(results),
+                'failed': len(failed),
+                'files': sorted([r.to_dict() for r in results], key=lambda r: r['key'])
+            }, f, indent=1, sort_keys=True)
+        
+        for r in failed:
+            logging.error("Integrity check failed for s3://%s/%s: expected ETag %s, got %s %s" % (
+                r.bucket_name, r.key, r.etag, r.actual_etag, r.error or ""))
+            if self.static_journal:
+                # Make a resumed deploy send it again
+                self.static_journal.record(r.key, '-', 0)
+        
+        logging.info("Verified %s of %s static files uploaded for release %s, report in %s" % (
+            len(results) - len(failed), len(results), self.release_id, report_path))
+        return not failed
+
+    def get_release_manifest(self):
+        """
+        Manifest for a per-release upload, built from the journal so files a
+        resumed deploy skipped are still listed.
+        """
+        prefix = self.make_static_release_key("") + "/"
+        files = {}
+        for key, (digest, size) in self.static_journal.entries.items():
+            if key.startswith(prefix) and digest != '-':
+                files[key[len(prefix):]] = {'sha256': digest, 'size': size}
+        return {
+            'version': MANIFEST_VERSION,
+            'paths': dict((rel, rel) for rel in files),
+            'files': files,
+            'layout': 'per-release',
+        }
+
+    @traced('upload_release_manifest')
+    def upload_release_manifest(self):
+        if self.pending_manifest:
+            (manifest_key, manifest) = self.pending_manifest
+        else:
+            manifest_key = self.make_static_release_key(self.config.static_manifest_name)
+            manifest = self.get_release_manifest()
+        manifest['release_id'] = self.release_id
+        
+        # The manifest goes last, a release without one never finished uploading
+        self.upload_file(self.get_static_bucket_name(), None, manifest_key, 'application/json',
+                         cache_control=self.MANIFEST_CACHE_CONTROL, body=dump_manifest(manifest),
+                         targets=self.get_static_targets())
+
+    def log_replication_stats(self):
+        """
+        Logs throughput for every region a static release went to, and how
+        far each replica lagged behind the primary bucket per file.
+        """
+        bucket_names = [b for _, b in self.get_static_targets()]
+        by_bucket = dict((b, []) for b in bucket_names)
+        for r in self.upload_results:
+            if r.bucket_name in by_bucket:
+                by_bucket[r.bucket_name].append(r)
+        
+        primary_finished = dict((r.key, r.finished) for r in by_bucket[bucket_names[0]])
+        for bucket_name in bucket_names:
+            results = by_bucket[bucket_name]
+            if not results:
+                continue
+            size = sum(r.size for r in results)
+            elapsed = max(r.finished for r in results) - min(r.started for r in results)
+            msg = "Static release %s to %s (%s): %s files, %.1f MB in %.1fs, %.2f MB/s" % (
+                self.release_id, bucket_name, results[0].region_name, len(results),
+                size / 1048576.0, elapsed, size / 1048576.0 / max(elapsed, 0.001))
+            if bucket_name != bucket_names[0]:
+                lags = [r.finished - primary_finished[r.key] for r in results if r.key in primary_finished]
+                if lags:
+                    msg += ", lag behind primary avg %.2fs max %.2fs" % (sum(lags) / len(lags), max(lags))
+            logging.info(msg)
+
+    @traced('upload_static_pooled')
+    def upload_static_pooled(self, static_paths):
+        layout = self.get_static_layout()
+        with self.tracer.span('static.plan'):
+            (pooled, stable, manifest) = layout.plan(static_paths)
+        manifest_key = self.make_static_release_key(self.config.static_manifest_name)
+        
+        # Each region's pool may be missing different assets, e.g. after a
+        # replica was added
+        targets = self.get_static_targets()
+        existing = [self.list_keys(bucket_name, layout.get_pool_prefix() + "/", region_name=region)
+                    for region, bucket_name in targets]
+        new_assets = []
+        for asset in pooled:
+            missing = [t for t, keys in zip(targets, existing) if layout.get_pool_key(asset) not in keys]
+            if missing:
+                new_assets.append((asset, missing))
+        
+        msg = "%s of %s static assets already in the pool, uploading %s new assets and %s stable files." % (
+            len(pooled) - len(new_assets), len(pooled), len(new_assets), len(stable))
+        logging.info(msg)
         
+        if self.dry_run:
+            msg = "Would upload %s pooled and %s stable files plus manifest %s, but in dry run mode." % (
+                len(new_assets), len(stable), manifest_key)
+            logging.info(msg)
+            return
+        
+        uploads = [(missing, a, layout.get_pool_key(a), self.POOL_CACHE_CONTROL) for a, missing in new_assets]
+        uploads += [(targets, a, self.make_static_release_key(a.rel_path), self.DEFAULT_CACHE_CONTROL)
+                    for a in stable]
+        
+        self.run_static_uploads(lambda u: self.upload_static_asset(*u), uploads,
+                                size_of=lambda u: len(u[1].content) if u[1].content is not None else u[1].size or 0)
+        
+        manifest['files'] = dict((a.rel_path, {'sha256': a.sha256, 'size': a.size}) for a in pooled + stable)
+        self.pending_manifest = (manifest_key, manifest)
+
     def params_as_dict(self, params):
         pdict = {}
         for p in params:
@@ -433,50 +1007,43 @@ class AppDeployer(object):
         
         return pdict
     
-    def dict_as_cfn_params(self, param_dict):
-        cfn_params = []
-        for key, val in param_dict.items():
-            cfn_params.append({
-                'ParameterKey': key,
-                'ParameterValue': val,
-                'UsePreviousValue': False
-            })
-        
-        return cfn_params
-    
-
+    @traced('cfndeploy')
     def cfndeploy(self, template_url=None, parameters=None):
-        params = {}
-        cfn_client = boto3.client('cloudformation')
-    
-        try:
-            response = cfn_client.describe_stacks(StackName=self.stack_name)
-            stacks = response['Stacks']
-            stack_params = self.params_as_dict(stacks[0]['Parameters'])
-
-            assert len(stacks) == 1
-            params.update(stack_params)
-            op = partial(cfn_client.update_stack,
+        cfn_client = self.aws.client('cloudformation')
+        stack = describe_stack(cfn_client, self.stack_name)
+        declared = get_template_parameters(cfn_client, template_url) if template_url else None
+        current = self.params_as_dict(stack.get('Parameters', [])) if stack else {}
+        plan = StackParameterPlan(current, parameters or {}, declared)
+        plan.log_summary(self.stack_name)
+        
+        # The token makes retrying a create/update that did go through harmless
+        token = "deploy-%s" % uuid.uuid4()
+        if stack is None:
+            logging.info("No stack named [%s], creating it" % self.stack_name)
+            op = partial(cfn_client.create_stack,
                         StackName=self.stack_name,
                         TemplateURL=template_url,
                         Capabilities=["CAPABILITY_IAM"],
-                        UsePreviousTemplate=False)
-        except:
-            logging.exception("Exception thrown trying to describe stack")
-            op = partial(cfn_client.create_stack,
+                        OnFailure='DO_NOTHING',
+                        ClientRequestToken=token)
+        else:
+            op = partial(cfn_client.update_stack,
                         StackName=self.stack_name,
                         TemplateURL=template_url,
                         Capabilities=["CAPABILITY_IAM"],
-                        OnFailure='DO_NOTHING')
-            print "Problem finding stack with name[%s]" % self.stack_name
-        params.update(parameters)
-        logging.info(op)
-        pprint(params)
-        
-        cfn_params = self.dict_as_cfn_params(params)
+                        UsePreviousTemplate=False,
+                        ClientRequestToken=token)
         
-        response = op(Parameters=cfn_params)
-        logging.info(response)
+        try:
+            response = call_with_retries(lambda: op(Parameters=plan.to_cfn_params()),
+                                         description="%s of stack %s" % ("Update" if stack else "Create", self.stack_name))
+        except ClientError, ex:
+            if stack is None or not is_no_op_update(ex):
+                raise
+            logging.info("Stack %s is already up to date" % self.stack_name)
+            return None
+        logging.info("%s stack %s: %s" % ("Updating" if stack else "Creating", self.stack_name, response['StackId']))
+        return response['StackId']
         
     def get_dry_run_str(self):
         if self.dry_run:
@@ -484,9 +1051,79 @@ class AppDeployer(object):
         else:
             return "LIVE DEPLOY:"    
 
-    def do_update_distro(self):
+    def get_pool_origin_id(self):
+        return 'S3-%s/pool' % self.get_static_bucket_name()
+
+    def add_pool_origin(self, dist_conf, release_origin_id):
+        """
+        Pooled assets live outside the release prefix, so they need their own
+        origin at the bucket root and a cache behavior routing the pool path
+        to it.
+        """
+        pool_origin_id = self.get_pool_origin_id()
+        origins = dist_conf['Origins']
+        if not any(o['Id'] == pool_origin_id for o in origins['Items']):
+            release_origin = [o for o in origins['Items'] if o['Id'] == release_origin_id][0]
+            pool_origin = copy.deepcopy(release_origin)
+            pool_origin['Id'] = pool_origin_id
+            pool_origin['OriginPath'] = ''
+            origins['Items'].append(pool_origin)
+            origins['Quantity'] = len(origins['Items'])
+        
+        path_pattern = self.get_static_layout().get_path_pattern()
+        behaviors = dist_conf.setdefault('CacheBehaviors', {'Quantity': 0})
+        items = behaviors.setdefault('Items', [])
+        if not any(b['PathPattern'] == path_pattern for b in items):
+            behavior = copy.deepcopy(dist_conf['DefaultCacheBehavior'])
+            behavior['PathPattern'] = path_pattern
+            behavior['TargetOriginId'] = pool_origin_id
+            for ttl_name in ['MinTTL', 'DefaultTTL', 'MaxTTL']:
+                if ttl_name in behavior:
+                    behavior[ttl_name] = 31536000
+            # Pool names never change content, so they can jump the queue
+            items.insert(0, behavior)
+            behaviors['Quantity'] = len(items)
+
+    def get_failover_group_id(self):
+        return 'S3-%s/failover' % self.get_static_bucket_name()
+
+    def set_failover_group(self, dist_conf, release_origin_id, release_id):
+        """
+        Puts the release origin and the first replica's copy of the release in
+        an origin group, so CloudFront falls back to the replica when the
+        primary bucket errors. Origin groups only take two members, so any
+        further replicas aren't part of the failover.
+        """
+        group_id = self.get_failover_group_id()
+        groups = dist_conf.setdefault('OriginGroups', {'Quantity': 0})
+        group_items = [g for g in groups.get('Items', []) if g['Id'] != group_id]
+        origins = dist_conf['Origins']
+        
+        if self.config.static_replicas:
+            (region, replica_bucket) = self.config.static_replicas[0]
+            release_origin = [o for o in origins['Items'] if o['Id'] == release_origin_id][0]
+            replica_origin = copy.deepcopy(release_origin)
+            replica_origin['Id'] = 'S3-%s/%s' % (replica_bucket, release_id)
+            replica_origin['DomainName'] = '%s.s3.%s.amazonaws.com' % (replica_bucket, region)
+            origins['Items'].append(replica_origin)
+            
+            status_codes = [500, 502, 503, 504]
+            group_items.append({
+                'Id': group_id,
+                'FailoverCriteria': {'StatusCodes': {'Quantity': len(status_codes), 'Items': status_codes}},
+                'Members': {'Quantity': 2, 'Items': [{'OriginId': release_origin_id},
+                                                     {'OriginId': replica_origin['Id']}]}
+            })
+            dist_conf['DefaultCacheBehavior']['TargetOriginId'] = group_id
+        
+        origins['Quantity'] = len(origins['Items'])
+        groups['Items'] = group_items
+        groups['Quantity'] = len(group_items)
+
+    @traced('do_update_distro')
+    def do_update_distro(self, distro=None, invalidation_paths=None):
         bucket_name = self.get_static_bucket_name()
-        distro = self.get_dist_for_stack()
+        distro = distro or self.get_dist_for_stack()
         distro_id = distro['Distribution']['Id']
         etag = distro['ETag']
         
@@ -499,28 +1136,163 @@ class AppDeployer(object):
         dist_conf = distro['Distribution']['DistributionConfig']
         dist_conf['DefaultCacheBehavior']['TargetOriginId'] = new_origin_id
         dist_conf['DefaultCacheBehavior']['Compress'] = True
-        for origin in dist_conf['Origins']['Items']:
+        pool_origin_id = self.get_pool_origin_id()
+        # Replica origins are rebuilt from the release origin below
+        replica_domains = tuple("%s." % b for _, b in self.config.static_replicas)
+        origins = dist_conf['Origins']
+        origins['Items'] = [o for o in origins['Items']
+                            if not (replica_domains and o['DomainName'].startswith(replica_domains))]
+        for origin in origins['Items']:
+            if origin['Id'] == pool_origin_id:
+                continue
             origin['Id'] = new_origin_id
             origin['OriginPath'] = '/%s' % use_release_id
+        
+        if self.config.static_layout == 'content-addressed':
+            self.add_pool_origin(dist_conf, new_origin_id)
+        self.set_failover_group(dist_conf, new_origin_id, use_release_id)
             
-        cf_client = boto3.client('cloudfront')
-        cf_client.update_distribution(DistributionConfig=dist_conf,
+        cf_client = self.aws.client('cloudfront')
+        response = cf_client.update_distribution(DistributionConfig=dist_conf,
                                Id=distro_id,
                                IfMatch=etag)
+        if 'Distribution' in response:
+            self.write_cached_distribution(response)
         
+        invalidation_paths = invalidation_paths or ['/*']
         inv_response = cf_client.create_invalidation(
             DistributionId=distro_id,
             InvalidationBatch={
                 'Paths': {
-                    'Quantity': 1,
-                    'Items': [
-                        '/*'
-                    ]
+                    'Quantity': len(invalidation_paths),
+                    'Items': invalidation_paths
                 },
                 'CallerReference': uuid.uuid4().hex
             }
         )
+        return inv_response
+
+    def get_release_manifest_key(self, release_id):
+        return "/".join([p for p in [release_id, self.get_static_prefix(), self.config.static_manifest_name] if p])
+
+    def fetch_release_manifest(self, release_id):
+        """
+        Returns a release's manifest, or None if it hasn't got one.
+        """
+        try:
+            response = self.aws.client('s3').get_object(Bucket=self.get_static_bucket_name(),
+                                                        Key=self.get_release_manifest_key(release_id))
+        except ClientError, ex:
+            if ex.response['Error']['Code'] in ('NoSuchKey', '404', 'AccessDenied'):
+                return None
+            raise
+        return json.loads(response['Body'].read())
+
+    def release_exists(self, release_id):
+        response = self.aws.client('s3').list_objects_v2(Bucket=self.get_static_bucket_name(),
+                                                         Prefix=release_id + "/", MaxKeys=1)
+        return bool(response.get('Contents'))
+
+    def get_served_files(self, manifest):
+        """
+        sha256 of everything a release serves under a name that isn't unique
+        to its content. Pooled names never change content, so they're left out.
+        """
+        pooled = manifest.get('paths', {}) if manifest.get('layout') == 'content-addressed' else {}
+        return dict((rel, f.get('sha256')) for rel, f in manifest.get('files', {}).items() if rel not in pooled)
+
+    def get_rollback_invalidation_paths(self, current_manifest, target_manifest):
+        """
+        Only the URLs whose content differs between the two releases, plus
+        the manifest itself, or /* if we can't tell or there are too many.
+        """
+        if not current_manifest or 'files' not in current_manifest or 'files' not in target_manifest:
+            return ['/*']
+        current = self.get_served_files(current_manifest)
+        target = self.get_served_files(target_manifest)
+        changed = set(rel for rel in set(current) | set(target) if current.get(rel) != target.get(rel))
+        changed.add(self.config.static_manifest_name)
+        if len(changed) > self.MAX_INVALIDATION_PATHS:
+            return ['/*']
+        prefix = self.get_static_prefix()
+        return sorted("/" + urllib2.quote("/".join([p for p in [prefix, rel] if p])) for rel in changed)
+
+    def wait_for_edge(self, domain_name, release_id, timeout=600, interval=5):
+        """
+        Polls the manifest through CloudFront until the edge serves the
+        release we switched to.
+        """
+        prefix = self.get_static_prefix()
+        url = "https://%s/%s" % (domain_name, "/".join([p for p in [prefix, self.config.static_manifest_name] if p]))
+        deadline = time.time() + timeout
+        while True:
+            try:
+                with closing(urllib2.urlopen(url, timeout=interval)) as response:
+                    if json.loads(response.read()).get('release_id') == release_id:
+                        return True
+            except (urllib2.URLError, IOError, ValueError), ex:
+                logging.debug("Waiting on %s: %s" % (url, ex))
+            if time.time() + interval > deadline:
+                return False
+            time.sleep(interval)
+
+    @traced('rollback')
+    def rollback(self):
+        """
+        Switches the distribution back to an existing release with as few
+        calls as possible: one GET for the target's manifest, the cached
+        distribution config and ETag, and an invalidation of only what
+        changed. Returns an exit status.
+        """
+        release_id = self.revert_distro
+        target_manifest = self.fetch_release_manifest(release_id)
+        if target_manifest is None:
+            # Releases from before manifests were uploaded only have their files
+            if not self.release_exists(release_id):
+                logging.error("Release %s does not exist in %s, not rolling back." % (
+                    release_id, self.get_static_bucket_name()))
+                return 1
+            logging.warn("Release %s has no manifest, invalidating everything." % release_id)
+            target_manifest = {}
+        
+        if self.dry_run:
+            logging.info("Would revert stack [%s] distro to release id [%s], but in dry run mode." % (
+                self.stack_name, release_id))
+            return 0
+        
+        cached = self.read_cached_distribution()
+        distro = cached or self.get_dist_for_stack()
+        while True:
+            current_path = self.get_distro_property(distro, 'Distribution', 'DistributionConfig',
+                                                    'Origins', 'Items', 0, 'OriginPath') or ''
+            current_manifest = self.fetch_release_manifest(current_path.strip('/')) if current_path.strip('/') else None
+            paths = self.get_rollback_invalidation_paths(current_manifest, target_manifest)
+            try:
+                invalidation = self.do_update_distro(distro, paths)
+                break
+            except ClientError, ex:
+                # Someone changed the distribution since we cached it
+                if not cached or ex.response['Error']['Code'] not in ('PreconditionFailed', 'NoSuchDistribution'):
+                    raise
+                self.clear_cached_distribution()
+                self.dist_index.pop(self.get_static_bucket_name(), None)
+                cached = None
+                distro = self.get_dist_for_stack()
+        
+        logging.info("Switched stack %s from %s to release %s, invalidating %s" % (
+            self.stack_name, current_path.strip('/') or "(unknown)", release_id, ", ".join(paths)))
         
+        if self.wait:
+            if not target_manifest:
+                logging.warn("Release %s has no manifest, can't tell when the edge serves it." % release_id)
+                return 0
+            if not self.wait_for_edge(distro['Distribution']['DomainName'], release_id, timeout=self.wait_timeout):
+                logging.error("CloudFront still wasn't serving release %s after %ss" % (release_id, self.wait_timeout))
+                return 1
+            logging.info("CloudFront is serving release %s" % release_id)
+        return 0
+        
+    @traced('deploy_static')
     def deploy_static(self):
         logging.info("Deploying static content for stack=[%s]" % self.stack_name)
         
@@ -538,14 +1310,15 @@ class AppDeployer(object):
         release_exists = False
         
         # Indicate which is the current one
-        s3 = boto3.resource('s3')
         bucket_name = self.get_static_bucket_name()
-        bucket = s3.Bucket(bucket_name)
-        result = bucket.meta.client.list_objects(Bucket=bucket.name, Delimiter='/')
+        result = self.aws.client('s3').list_objects(Bucket=bucket_name, Delimiter='/')
         prefixes = result.get('CommonPrefixes')
         if prefixes:
+            pool_root = self.get_static_layout().get_pool_prefix().split('/')[0] + '/'
             for o in prefixes:
                 release = o.get('Prefix')
+                if self.config.static_layout == 'content-addressed' and release == pool_root:
+                    continue
                 if curr_origin_path.strip('/') in release.strip('/'):
                     release_list.append("%s (current)" % release)
                 else:
@@ -556,26 +1329,15 @@ class AppDeployer(object):
         msg = "Static releases in stack [%s]:\n\t%s" % (self.stack_name, "\n\t".join(release_list))
         logging.info(msg)
         
-        if self.revert_distro:
-            try:
-                if self.dry_run:
-                    msg = "Would revert stack [%s] distro to release id [%s], but in dry run mode." % (self.stack_name, self.revert_distro)
-                    logging.info(msg)
-                else:
-                    # 4. Update the distro to point to the new origin
-                    self.do_update_distro()
-            except ClientError, ex:
-                if ex.response['Error']['Code'] == 'AccessDenied':
-                    msg = "usage: BOTO_CONFIG=<your credentials file path> python deploy_static.py"
-                    logging.info(msg)
-            exit(0)
-        
         # Give an error if release id specified already exists in bucket
-        if self.upload_content and release_exists:
+        if self.upload_content and release_exists and not self.resume:
             msg = "The release id you have specified (%s) already exists. \nYou can only upload static content to a release id that does not exist yet." % self.release_id
             logging.error(msg)
             exit(1)
         
+        if self.upload_content and not self.exec_pre_deploy_hooks():
+            exit(1)
+        
         # Order of operations:
         # 1. OS walk over static files
         if self.upload_content:
@@ -583,28 +1345,66 @@ class AppDeployer(object):
                 if self.dry_run:
                     msg = "Would upload contents of %s to stack %s and release id %s, but in dry run mode." % (self.static_src_root, self.stack_name, self.release_id)
                     logging.info(msg)
+                    if self.config.static_replicas:
+                        logging.info("Would replicate to %s, but in dry run mode." % ", ".join(
+                            "%s (%s)" % (b, r) for r, b in self.config.static_replicas))
+                
+                static_exclusions = self.config.static_exclusion_paths
+                static_paths = []
+                with self.tracer.span('static.walk'):
+                    for root, dirs, files in os.walk(self.static_src_root):
+                        for path in files:
+                            fpath = os.path.join(root, path)
+                            
+                            if root in static_exclusions:
+                                logging.info("Excluding folder: %s" % fpath)
+                            else:
+                                # print "fpath: %s" % fpath
+                                static_paths.append(fpath)
                 
-                for root, dirs, files in os.walk(self.static_src_root):
-                    for path in files:
-                        fpath = os.path.join(root, path)
-                        
-                        if 'static-folder-exclusions' in self.deploy_configs:
-                            static_exclusions = self.deploy_configs['static-folder-exclusions']
-                        else:
-                            static_exclusions = []
-                        
-                        static_exclusions = map(lambda x: os.path.join(self.static_src_root, x), static_exclusions)
-                        if os.path.dirname(fpath) in static_exclusions:
-                            logging.info("Excluding folder: %s" % fpath)
-                        else:
-                            # print "fpath: %s" % fpath
-                            # 2. Upload files to $new_origin (which is currently a new folder in S3)
-                            self.upload_static(src_path=fpath)
+                # The deploy writes its own manifest at that key, it would overwrite the file
+                manifest_name = self.config.static_manifest_name
+                clashes = [p for p in static_paths
+                           if os.path.relpath(p, self.static_src_root).replace(os.path.sep, '/') == manifest_name]
+                if clashes:
+                    logging.error("%s is where the release manifest goes, pick another static-manifest-name." % clashes[0])
+                    exit(1)
+                
+                if not self.dry_run:
+                    # A fresh deploy of a release id throws away any journal left behind for it
+                    self.static_journal = StaticDeployJournal.open(self.get_static_journal_dir(), self.release_id,
+                                                                   self.stamp, self.blessed, reset=not self.resume)
+                
+                # 2. Upload files to $new_origin (which is currently a new folder in S3)
+                if self.config.static_layout == 'content-addressed':
+                    self.upload_static_pooled(static_paths)
+                else:
+                    self.run_static_uploads(self.upload_static, static_paths, size_of=os.path.getsize)
+                
+                if not self.dry_run:
+                    self.log_replication_stats()
+                    if self.config.verify_uploads and not self.verify_static_release():
+                        logging.error("Static deploy of release %s failed verification, re-run with --resume to upload the failed files again." % self.release_id)
+                        exit(1)
+                    self.upload_release_manifest()
+                
+                if self.static_journal:
+                    self.static_journal.mark_complete()
             except ClientError, ex:
                 print ex
                 if ex.response['Error']['Code'] == 'AccessDenied':
                     msg = "usage: BOTO_CONFIG=<your credentials file path> python deploy_static.py"
                     logging.info(msg)
+                logging.error("Static deploy of release %s did not finish, re-run with --resume to pick up where it stopped." % self.release_id)
+                exit(1)
+            except (HTTPClientError, BotoConnectionError), ex:
+                # What's left once upload retries give up on the network
+                logging.error(str(ex))
+                logging.error("Static deploy of release %s did not finish, re-run with --resume to pick up where it stopped." % self.release_id)
+                exit(1)
+            finally:
+                if self.static_journal:
+                    self.static_journal.close()
     
         
         if self.update_distro:
@@ -620,7 +1420,19 @@ class AppDeployer(object):
                     msg = "usage: BOTO_CONFIG=<your credentials file path> python deploy_static.py"
                     logging.info(msg)    
 
+    @traced('deploy_application')
     def deploy_application(self):
+        ### Make db migrations in the background while templates upload and validate
+        migration = self.deploy_lib.start_db_migrations()
+        try:
+            self._deploy_application(migration)
+        finally:
+            # No-op unless we bailed out before the migrations finished
+            migration.cancel()
+
+    def _deploy_application(self, migration):
+        if not self.exec_pre_deploy_hooks():
+            exit(1)
         
         if self.verbose or self.dry_run:
             logging.info("%s Deploying application for stack=[%s], product=[%s], template=[%s], template_url=[%s], params=[%s]" % (
@@ -653,11 +1465,8 @@ class AppDeployer(object):
                     template_url
                 ))
         else:
-            template_root_path_parts = self.deploy_configs['cfn-template-root-path']
-            all_path_parts = template_root_path_parts + [self.deploy_configs['root-template-name']]
-            
             #root_temp_path = os.path.join(".", "arm_app", "conf", "cfn", self.ROOT_TEMPLATE_NAME)
-            root_temp_path = os.path.join(*all_path_parts)
+            root_temp_path = self.config.root_template_path
 
             if self.verbose or self.dry_run:
                 logging.info("%s Uploading template using default path for stack=[%s], release_id=[%s], file=[%s]" % (
@@ -673,15 +1482,10 @@ class AppDeployer(object):
             else:
                 logging.error("Could not find template at %s" % root_temp_path)
         
-        template_root_path_parts = self.deploy_configs['cfn-template-root-path']
         child_stack_template_urls = {}
         
-        if 'nested-stack-templates' in self.deploy_configs:
-            nested_stack_filenames = self.deploy_configs['nested-stack-templates']
-            for nsf in nested_stack_filenames:
-                nsf_path_parts = template_root_path_parts + [nsf]
-                nsf_temp_path = os.path.join(*nsf_path_parts)
-    
+        if self.config.nested_template_paths:
+            for nsf, nsf_temp_path in self.config.nested_template_paths:
                 if self.verbose or self.dry_run:
                     logging.info("%s Uploading nested template using default path for stack=[%s], release_id=[%s], file=[%s]" % (
                         self.get_dry_run_str(),
@@ -714,19 +1518,20 @@ class AppDeployer(object):
         
         if not self.dry_run:
             ## Validate the template before we do anything else:
-            cfn_client = boto3.client('cloudformation')
-            try:
-                resp1 = cfn_client.validate_template(TemplateURL=root_template_url)
-            except:
-                logging.exception("Problem validating template %s." % root_template_url)
-                return
-            
-            for cst_name, cst_url in child_stack_template_urls.items():
+            cfn_client = self.aws.client('cloudformation')
+            with self.tracer.span('validate_templates'):
                 try:
-                    resp2 = cfn_client.validate_template(TemplateURL=cst_url)
+                    resp1 = cfn_client.validate_template(TemplateURL=root_template_url)
                 except:
-                    logging.exception("Problem validating template %s." % cst_url)
+                    logging.exception("Problem validating template %s." % root_template_url)
                     return
+                
+                for cst_name, cst_url in child_stack_template_urls.items():
+                    try:
+                        resp2 = cfn_client.validate_template(TemplateURL=cst_url)
+                    except:
+                        logging.exception("Problem validating template %s." % cst_url)
+                        return
 
         if self.verbose or self.dry_run:
             logging.info("%s Building application" % (
@@ -738,23 +1543,33 @@ class AppDeployer(object):
                 self.get_dry_run_str()
             ))
             
-        ### Make any db migrations necessary
-        (status, stdout, stderr) = self.deploy_lib.run_db_migrations()
+        ### Wait on any db migrations necessary
+        with self.tracer.span('db_migrations.wait'):
+            (status, stdout, stderr) = migration.wait()
+        if getattr(migration, 'started', None):
+            self.tracer.add_span('db_migrations', migration.started, migration.finished, thread=migration.thread)
         logging.info("%s db migration output: %s" % (self.get_dry_run_str(), stdout))
         if status != 0:
             logging.error("Problem making db migrations: %s" % stderr)
             return
         
         params = self.parameters or {}
-        tarball = self.build()
-        
-        if self.verbose or self.dry_run:
-            logging.info("%s Uplading application tarball" % (
-                self.get_dry_run_str(),
-            ))
-        
-        if not self.dry_run:
-            url = self.upload_app(tarball)
+        if self.config.build_backend == 'parallel':
+            if self.verbose or self.dry_run:
+                logging.info("%s Building and uploading application archive" % (
+                    self.get_dry_run_str(),
+                ))
+            url = self.build_and_upload_app()
+        else:
+            tarball = self.build()
+            
+            if self.verbose or self.dry_run:
+                logging.info("%s Uplading application tarball" % (
+                    self.get_dry_run_str(),
+                ))
+            
+            if not self.dry_run:
+                url = self.upload_app(tarball)
         
         if self.verbose or self.dry_run:
             logging.info("%s Deploying application to CloudFormation" % (
@@ -762,7 +1577,7 @@ class AppDeployer(object):
             ))
         
         if not self.dry_run:
-            temp_params = self.deploy_configs['template-parameter-names']
+            temp_params = self.config.template_parameter_names
 
             params[temp_params['application-source-parameter-name']] = url
             params[temp_params['release-id-parameter-name']] = self.release_id
@@ -806,8 +1621,7 @@ class AppDeployer(object):
             result[n] = v
         return result
 
-if __name__ == "__main__":
-    
+def make_arg_parser():
     arg_parser = ArgumentParser("Deploy to AWS. Please be sure to use AWS_CONFIG_FILE=<file> for your credentials")
     arg_parser.add_argument("--config-path", default="./scripts/deploy-config.yaml",
                             help="Config for this specific company, project, and product.")
@@ -827,6 +1641,7 @@ if __name__ == "__main__":
     ### TODO: Make a custom argparse Action that validates against a preset list of options for db migrator
     arg_parser.add_argument("--db-migrator", action="store", help="How to run db migrations.")
     arg_parser.add_argument("--no-db-migrations", action="store_true", default=False, help="Deploy without db migrations")
+    arg_parser.add_argument("--force-db-migrations", action="store_true", default=False, help="Run db migrations even if no models or migrations changed since the last successful run.")
     arg_parser.add_argument("--product", help="Product name we are deploying. Defaults by using a PRODUCT file with a single string in it.")
     arg_parser.add_argument("--stamp", default=int(time.time()),
                             help="Time stamp as seconds since the epoch to use for generating release id")
@@ -836,26 +1651,39 @@ if __name__ == "__main__":
                                  to leave off the compressed date stamp and commit id., \
                                  i.e., a release that looks like adaptrm-dev-aws-1.0.2 instead \
                                  of adaptrm-dev-aws-1.0.1-20160318T163105-60d00d7")
+    arg_parser.add_argument("--resume", action="store_true", default=False,
+                            help="Resume the last interrupted static deploy for this stack, only uploading \
+                                 the files it had not finished.")
+    arg_parser.add_argument("--wait", action="store_true", default=False,
+                            help="With --change-cloudfront-origin, block until CloudFront serves the release.")
+    arg_parser.add_argument("--wait-timeout", type=int, default=600,
+                            help="Seconds --wait gives CloudFront before giving up.")
+    arg_parser.add_argument("--trace-out", help="Write a Chrome trace-event file of the deploy's phases to this path.")
     arg_parser.add_argument("--dry-run", action="store_true", default=False)
     arg_parser.add_argument("--verbose", action="store_true", default=False)
     arg_parser.add_argument("stack_name")
-    args = arg_parser.parse_args()
-    
+    return arg_parser
+
+def run(args, warm=None):
+    """
+    Runs a deploy for parsed command line args, returning the exit status.
+    """
     if not args.config_path:
         print "--config-path is required. Please use deploy-config.yaml.sample as an example."
-        exit(1)
+        return 1
 
     try:
-        deployer = AppDeployer(**args.__dict__)
+        deployer = AppDeployer(warm=warm, **args.__dict__)
     except:
         logging.exception("Problem initializing AppDeployer.")
-        exit(1)
+        return 1
     
     any_static = not deployer.no_static and any([deployer.upload_content, deployer.update_distro, deployer.revert_distro])
     any_app = deployer.deploy_app
     
     try:
-        
+        if deployer.revert_distro:
+            return deployer.rollback()
         
         if any_static:
             deployer.deploy_static()
@@ -868,3 +1696,11 @@ if __name__ == "__main__":
         if ex.response['Error']['Code'] == 'AccessDenied':
             msg = "usage: BOTO_CONFIG=<your credentials file path> python deploy.py"
             logging.info(msg)
+    finally:
+        deployer.write_api_metrics()
+        deployer.write_trace()
+        deployer.close()
+    return 0
+
+if __name__ == "__main__":
+    exit(run(make_arg_parser().parse_args()))
@@ -0,0 +1,970 @@
+# -*- coding: utf-8 -*-
+"""
+Shared AWS session and client pool for a deploy run.
+
+Every AWS call the deployer makes goes through one ClientPool, so credentials
+are resolved once, clients (and their connection pools) are created once per
+service/region, and all of them share a botocore Config tuned for the number
+of upload workers.
+"""
+
+import os
+import sys
+import time
+import random
+import mmap
+import base64
+import logging
+import threading
+from collections import Counter, deque, namedtuple
+from hashlib import md5, sha256
+from multiprocessing.pool import ThreadPool
+
+import boto3
+import botocore
+from botocore.config import Config
+from botocore.exceptions import ClientError, HTTPClientError, ConnectionError as BotoConnectionError
+
+DEFAULT_MAX_WORKERS = 10
+DEFAULT_MAX_ATTEMPTS = 10
+# Parts a single multipart upload sends at once
+DEFAULT_PART_WORKERS = 4
+MULTIPART_THRESHOLD = 8 * 1024 * 1024
+PART_SIZE = 8 * 1024 * 1024
+MAX_PARTS = 10000
+# Every part but the last has to be at least this big
+MIN_PART_SIZE = 5 * 1024 * 1024
+# A request costs about as much as sending this many bytes, so a window's
+# throughput counts the files in it as well as their size
+REQUEST_OVERHEAD_BYTES = 64 * 1024
+# Upload concurrency is tuned separately for files under SMALL_FILE_SIZE,
+# files up to the multipart threshold and multipart uploads, largest first
+SMALL_FILE_SIZE = 1024 * 1024
+SIZE_CLASSES = ('large', 'medium', 'small')
+
+def get_pool_connections(max_workers, part_workers=DEFAULT_PART_WORKERS):
+    # Every worker may be in the middle of a multipart upload with
+    # part_workers parts in flight, all on the same client
+    return max_workers * part_workers
+
+def make_client_config(max_workers=DEFAULT_MAX_WORKERS, max_attempts=DEFAULT_MAX_ATTEMPTS,
+                       part_workers=DEFAULT_PART_WORKERS):
+    options = {
+        'max_pool_connections': get_pool_connections(max_workers, part_workers),
+        'retries': {'mode': 'adaptive', 'max_attempts': max_attempts},
+    }
+    # Older botocore releases don't know about every option, drop the ones
+    # they would reject.
+    supported = getattr(Config, 'OPTION_DEFAULTS', options)
+    for name in options.keys():
+        if name not in supported:
+            logging.debug("botocore %s does not support Config option %s, ignoring." % (botocore.__version__, name))
+            del options[name]
+    return Config(**options)
+
+THROTTLE_ERROR_CODES = frozenset([
+    'SlowDown',
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestThrottled',
+    'RequestThrottledException',
+    'TooManyRequestsException',
+    'RequestLimitExceeded',
+    'BandwidthLimitExceeded',
+    'PriorRequestNotComplete',
+])
+
+def is_transient_error(ex):
+    """
+    Whether an error from an AWS call is worth retrying: throttling, a 5xx,
+    or the connection failing.
+    """
+    if isinstance(ex, ClientError):
+        status = ex.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+        return ex.response.get('Error', {}).get('Code') in THROTTLE_ERROR_CODES or status >= 500
+    return isinstance(ex, (BotoConnectionError, HTTPClientError))
+
+def call_with_retries(op, attempts=5, delay=1.0, max_delay=30.0, description="AWS call"):
+    """
+    Calls op() until it succeeds, retrying transient errors with jittered
+    exponential backoff. botocore's own retries happen inside each attempt,
+    this covers what's left when they run out.
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            return op()
+        except Exception, ex:
+            if attempt == attempts or not is_transient_error(ex):
+                raise
+            wait = min(max_delay, delay * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+            logging.warn("%s failed (%s), retrying in %.1fs [%s/%s]" % (description, ex, wait, attempt, attempts))
+            time.sleep(wait)
+
+class TokenBucket(object):
+    """
+    Token bucket that lets callers go into debt: acquire() always takes the
+    tokens and then sleeps off any deficit, so a request bigger than the
+    bucket (a 64MB part against a 10MB/s limit) still goes through, just
+    late.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = burst
+        self.capacity = float(burst or max(self.rate, 1.0))
+        self.tokens = self.capacity
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def _set_rate(self, rate):
+        self._refill()
+        self.rate = float(rate)
+        if not self.burst:
+            self.capacity = max(self.rate, 1.0)
+            self.tokens = min(self.tokens, self.capacity)
+
+    def acquire(self, amount=1):
+        with self.lock:
+            self._refill()
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+class AIMDTokenBucket(TokenBucket):
+    """
+    A TokenBucket whose rate halves (at most once per cooldown) when the
+    service throttles us, and creeps back up towards the configured rate by
+    `increase` per second of successful calls.
+    """
+    COOLDOWN = 1.0
+
+    def __init__(self, rate, burst=None, min_rate=None, increase=None, decrease=0.5):
+        super(AIMDTokenBucket, self).__init__(rate, burst)
+        self.max_rate = self.rate
+        self.min_rate = float(min_rate or max(self.rate / 50.0, 0.2))
+        self.increase = float(increase or max(self.rate / 20.0, 0.1))
+        self.decrease = decrease
+        self.last_decrease = 0.0
+        self.last_increase = time.time()
+
+    def on_throttle(self):
+        with self.lock:
+            now = time.time()
+            if now - self.last_decrease >= self.COOLDOWN:
+                self._set_rate(max(self.min_rate, self.rate * self.decrease))
+                self.last_decrease = now
+                self.last_increase = now
+                logging.info("Throttled, backing off to %.1f requests/s" % self.rate)
+
+    def on_success(self):
+        if self.rate >= self.max_rate:
+            return
+        with self.lock:
+            now = time.time()
+            if now - self.last_increase >= 1.0:
+                self._set_rate(min(self.max_rate, self.rate + self.increase * (now - self.last_increase)))
+                self.last_increase = now
+
+class Limits(object):
+    def __init__(self, conf):
+        self.requests = None
+        self.bytes = None
+        if conf.get('requests-per-second'):
+            self.requests = AIMDTokenBucket(conf['requests-per-second'],
+                                            burst=conf.get('burst'),
+                                            min_rate=conf.get('min-requests-per-second'))
+        if conf.get('bytes-per-second'):
+            self.bytes = TokenBucket(conf['bytes-per-second'])
+
+    def acquire(self, nbytes):
+        waited = 0.0
+        if self.requests:
+            waited += self.requests.acquire()
+        if self.bytes and nbytes:
+            waited += self.bytes.acquire(nbytes)
+        return waited
+
+    def on_throttle(self):
+        if self.requests:
+            self.requests.on_throttle()
+
+    def on_success(self):
+        if self.requests:
+            self.requests.on_success()
+
+class ClientObserver(object):
+    """
+    Base for anything a ClientPool hooks up to its clients: EVENTS lists the
+    (event name, method name) pairs to register.
+    """
+    EVENTS = ()
+
+    def register(self, client):
+        for event_name, handler_name in self.EVENTS:
+            client.meta.events.register(event_name, getattr(self, handler_name))
+
+    def unregister(self, client):
+        for event_name, handler_name in self.EVENTS:
+            client.meta.events.unregister(event_name, getattr(self, handler_name))
+
+def get_payload_size(params):
+    if 'ContentLength' in params:
+        return params['ContentLength']
+    body = params.get('Body')
+    if body is None:
+        return 0
+    try:
+        return len(body)
+    except TypeError:
+        return 0
+
+class RateLimiter(ClientObserver):
+    """
+    Client-side rate limiting for every client in a ClientPool, driven by
+    the rate-limits config:
+
+        rate-limits:
+            s3:
+                requests-per-second: 300
+                bytes-per-second: 52428800
+                prefixes:
+                    "app/":
+                        requests-per-second: 20
+            cloudfront:
+                requests-per-second: 2
+
+    Limits for a key prefix apply on top of the limits for its service.
+    Throttling responses shrink the request rate (AIMD), and calls,
+    throttles, retries, errors and time spent waiting are counted per
+    service.
+    """
+    EVENTS = (
+        ('before-parameter-build.*.*', 'before_parameter_build'),
+        ('before-call.*.*', 'before_call'),
+        ('needs-retry.*.*', 'needs_retry'),
+        ('after-call.*.*', 'after_call'),
+        ('after-call-error.*.*', 'after_call_error'),
+    )
+
+    def __init__(self, limits_config=None):
+        self.service_limits = {}
+        self.prefix_limits = {}
+        for service_name, conf in (limits_config or {}).items():
+            self.service_limits[service_name] = Limits(conf)
+            prefixes = [(prefix, Limits(prefix_conf)) for prefix, prefix_conf in (conf.get('prefixes') or {}).items()]
+            # Longest prefix wins
+            self.prefix_limits[service_name] = sorted(prefixes, key=lambda p: -len(p[0]))
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def count(self, service_name, name, amount=1):
+        with self.lock:
+            if service_name not in self.counters:
+                self.counters[service_name] = Counter()
+            self.counters[service_name][name] += amount
+
+    def get_counters(self):
+        with self.lock:
+            return dict((service_name, dict(counter)) for service_name, counter in self.counters.items())
+
+    def get_limits(self, service_name, params):
+        limits = []
+        if service_name in self.service_limits:
+            limits.append(self.service_limits[service_name])
+        key = params.get('Key')
+        if key:
+            for prefix, prefix_limits in self.prefix_limits.get(service_name, []):
+                if key.startswith(prefix):
+                    limits.append(prefix_limits)
+                    break
+        return limits
+
+    def before_parameter_build(self, params, model, context, **kwargs):
+        service_name = model.service_model.service_name
+        context['rate-limit-service'] = service_name
+        context['rate-limit-limits'] = self.get_limits(service_name, params)
+        context['rate-limit-bytes'] = get_payload_size(params)
+
+    def _acquire(self, context):
+        waited = 0.0
+        for limits in context.get('rate-limit-limits', []):
+            waited += limits.acquire(context.get('rate-limit-bytes', 0))
+        if waited:
+            self.count(context['rate-limit-service'], 'wait-seconds', waited)
+
+    def before_call(self, context, **kwargs):
+        self.count(context.get('rate-limit-service'), 'calls')
+        self._acquire(context)
+
+    def needs_retry(self, response=None, request_dict=None, **kwargs):
+        if not response or not request_dict:
+            return None
+        context = request_dict.get('context', {})
+        http_response, parsed = response
+        code = parsed.get('Error', {}).get('Code')
+        if code in THROTTLE_ERROR_CODES or http_response.status_code == 429:
+            self.count(context.get('rate-limit-service'), 'throttles')
+            for limits in context.get('rate-limit-limits', []):
+                limits.on_throttle()
+            # The retry that follows has to wait its turn like any other call
+            self._acquire(context)
+        # Leave the actual retry decision to botocore
+        return None
+
+    def after_call(self, http_response, parsed, context, **kwargs):
+        service_name = context.get('rate-limit-service')
+        retries = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+        if retries:
+            self.count(service_name, 'retries', retries)
+        if http_response.status_code < 300:
+            for limits in context.get('rate-limit-limits', []):
+                limits.on_success()
+        else:
+            self.count(service_name, 'errors')
+
+    def after_call_error(self, context, **kwargs):
+        self.count(context.get('rate-limit-service'), 'errors')
+
+    def log_counters(self):
+        for service_name, counter in sorted(self.get_counters().items()):
+            logging.info("AWS %s: %s" % (service_name, ", ".join("%s=%s" % (k, round(v, 2) if isinstance(v, float) else v)
+                                                             for k, v in sorted(counter.items()))))
+        for service_name, limits in sorted(self.service_limits.items()):
+            if limits.requests and limits.requests.rate < limits.requests.max_rate:
+                logging.info("AWS %s request rate ended at %.1f/s of %.1f/s allowed" % (
+                    service_name, limits.requests.rate, limits.requests.max_rate))
+
+class ClientPool(object):
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS, region_name=None, profile_name=None,
+                 observers=None):
+        self.max_workers = max_workers
+        self.pool_connections = get_pool_connections(max_workers)
+        self.session = boto3.session.Session(region_name=region_name, profile_name=profile_name)
+        self.config = make_client_config(max_workers)
+        # Anything with a register(client) method, hooked up to every client
+        # we create.
+        self.observers = observers or []
+        self.clients = {}
+        # boto3 clients are thread safe, sessions are not, so only ever
+        # create clients while holding the lock.
+        self.lock = threading.Lock()
+
+    def client(self, service_name, region_name=None):
+        # The session's own region and naming it explicitly share a client
+        key = (service_name, region_name or self.session.region_name)
+        client = self.clients.get(key)
+        if client is None:
+            with self.lock:
+                if key not in self.clients:
+                    client = self.session.client(service_name, region_name=region_name,
+                                                 config=self.config)
+                    for observer in self.observers:
+                        observer.register(client)
+                    self.clients[key] = client
+                client = self.clients[key]
+        return client
+
+    def set_observers(self, observers):
+        """
+        Swaps the observers on every client, so a warm pool can be handed
+        from one deploy to the next.
+        """
+        with self.lock:
+            for client in self.clients.values():
+                for observer in self.observers:
+                    observer.unregister(client)
+                for observer in observers:
+                    observer.register(client)
+            self.observers = list(observers)
+
+class UploadResult(object):
+    def __init__(self, bucket_name, key, size, sha256_digest, etag, md5_digest=None, region_name=None):
+        self.bucket_name = bucket_name
+        self.key = key
+        self.size = size
+        self.sha256 = sha256_digest
+        self.etag = etag
+        self.md5 = md5_digest
+        self.region_name = region_name
+        self.started = None
+        self.finished = None
+        self.actual_etag = None
+        self.verified = None
+        self.error = None
+
+    def to_dict(self):
+        return {
+            'bucket': self.bucket_name,
+            'region': self.region_name,
+            'key': self.key,
+            'size': self.size,
+            'sha256': self.sha256,
+            'etag': self.etag,
+            'actual_etag': self.actual_etag,
+            'verified': self.verified,
+            'error': self.error,
+        }
+
+def hash_data(data, blocksize=1 << 20):
+    """
+    (md5, sha256) hex digests of a string or memory map, from one pass over
+    it in blocks.
+    """
+    md5_digest = md5()
+    sha256_digest = sha256()
+    for offset in range(0, len(data), blocksize):
+        block = buffer(data, offset, blocksize)
+        md5_digest.update(block)
+        sha256_digest.update(block)
+    return (md5_digest.hexdigest(), sha256_digest.hexdigest())
+
+def upload_hashed(targets, key, filename=None, body=None, extra_args=None,
+                  multipart_threshold=MULTIPART_THRESHOLD, part_size=PART_SIZE, part_workers=DEFAULT_PART_WORKERS,
+                  digests=None, pool=None):
+    """
+    Uploads a file (or an in-memory body) with Content-MD5 set to every
+    (client, bucket_name) in targets, all at once, computing the MD5,
+    the SHA-256 and the ETag S3 should end up with from the same bytes that
+    are sent. The file is read and hashed once however many targets there
+    are, and memory mapped rather than read into fresh buffers. digests, the
+    (md5, sha256) hex digests of the content if the caller already has them,
+    saves hashing it again. Replicas are sent to from pool (see map_targets).
+    Returns an UploadResult per target.
+    """
+    extra_args = extra_args or {}
+    if body is not None:
+        return _put_hashed(targets, key, body, extra_args, digests, pool=pool)
+    
+    size = os.path.getsize(filename)
+    with open(filename, 'rb') as f:
+        if size == 0:
+            return _put_hashed(targets, key, '', extra_args, digests, pool=pool)
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if size < multipart_threshold:
+                # A map has a single read position, so each target reads
+                # through a map of its own
+                return _put_hashed(targets, key, mm, extra_args, digests, pool=pool,
+                                   open_body=lambda: mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            return _multipart_hashed(targets, key, mm, extra_args, part_size, part_workers, digests, pool=pool)
+        finally:
+            mm.close()
+
+def map_targets(fn, targets, pool=None):
+    """
+    fn(client, bucket_name) for every target at once, so a slow replica
+    doesn't hold up the others: the first target on the calling thread, the
+    rest on pool (a ThreadPool shared across uploads, one just for this call
+    if None). Results come back in target order.
+    """
+    if len(targets) == 1:
+        return [fn(*targets[0])]
+    own_pool = pool is None
+    if own_pool:
+        pool = ThreadPool(len(targets) - 1)
+    try:
+        pending = [pool.apply_async(fn, target) for target in targets[1:]]
+        first = fn(*targets[0])
+        return [first] + [p.get() for p in pending]
+    finally:
+        if own_pool:
+            pool.terminate()
+
+def _put_hashed(targets, key, data, extra_args, digests=None, pool=None, open_body=None):
+    """
+    open_body, if given, opens a fresh copy of data for each target to read.
+    """
+    (md5_hex, sha256_digest) = digests or hash_data(data)
+    content_md5 = base64.b64encode(md5_hex.decode('hex'))
+    
+    def put(client, bucket_name):
+        result = UploadResult(bucket_name, key, len(data), sha256_digest,
+                              '"%s"' % md5_hex, md5_hex,
+                              region_name=client.meta.region_name)
+        body = open_body() if open_body is not None else data
+        try:
+            result.started = time.time()
+            client.put_object(Bucket=bucket_name, Key=key, Body=body, ContentMD5=content_md5, **extra_args)
+            result.finished = time.time()
+        finally:
+            if body is not data:
+                body.close()
+        return result
+    
+    return map_targets(put, targets, pool)
+
+def _multipart_hashed(targets, key, mm, extra_args, part_size, part_workers, digests=None, pool=None):
+    size = len(mm)
+    # S3 caps an upload at 10,000 parts
+    part_size = max(part_size, -(-size // MAX_PARTS))
+    offsets = range(0, size, part_size)
+    
+    # Part MD5s and the whole file's SHA-256 in one pass over it
+    whole = sha256() if digests is None else None
+    part_md5s = {}
+    for n, offset in enumerate(offsets):
+        block = buffer(mm, offset, part_size)
+        part_md5s[n + 1] = md5(block).digest()
+        if whole is not None:
+            whole.update(block)
+    sha256_digest = whole.hexdigest() if whole is not None else digests[1]
+    
+    def upload(client, bucket_name):
+        started = time.time()
+        upload_id = client.create_multipart_upload(Bucket=bucket_name, Key=key, **extra_args)['UploadId']
+        
+        def send_part(part):
+            (part_number, offset) = part
+            response = client.upload_part(Bucket=bucket_name, Key=key, UploadId=upload_id,
+                                          PartNumber=part_number, Body=mm[offset:offset + part_size],
+                                          ContentMD5=base64.b64encode(part_md5s[part_number]))
+            return (part_number, response['ETag'])
+        
+        # A part pool per target, the client's connection pool is sized for
+        # part_workers per file
+        pool = ThreadPool(min(part_workers, len(offsets)))
+        try:
+            parts = sorted(pool.map(send_part, [(n + 1, o) for n, o in enumerate(offsets)]))
+            client.complete_multipart_upload(Bucket=bucket_name, Key=key, UploadId=upload_id,
+                                             MultipartUpload={'Parts': [{'PartNumber': n, 'ETag': etag}
+                                                                        for n, etag in parts]})
+        except:
+            client.abort_multipart_upload(Bucket=bucket_name, Key=key, UploadId=upload_id)
+            raise
+        finally:
+            pool.terminate()
+        
+        etag = '"%s-%s"' % (md5("".join(part_md5s[n] for n, _ in parts)).hexdigest(), len(parts))
+        result = UploadResult(bucket_name, key, size, sha256_digest, etag,
+                              region_name=client.meta.region_name)
+        (result.started, result.finished) = (started, time.time())
+        return result
+    
+    return map_targets(upload, targets, pool)
+
+class MultipartUploadStream(object):
+    """
+    File-like object that uploads whatever is written to it to every
+    (client, bucket_name) in targets, one multipart part at a time, so
+    something generated on the fly (a build archive) never has to touch
+    disk. Parts go out in the background, with at most part_workers of them
+    buffered at once. close() returns an UploadResult per target, with the
+    hashes of everything written.
+    """
+    def __init__(self, targets, key, extra_args=None, part_size=PART_SIZE, part_workers=DEFAULT_PART_WORKERS):
+        self.targets = targets
+        self.key = key
+        self.extra_args = extra_args or {}
+        self.part_size = part_size
+        self.buffer = []
+        self.buffered = 0
+        self.size = 0
+        self.sha256 = sha256()
+        self.upload_ids = None
+        self.pending = []
+        self.pool = ThreadPool(part_workers)
+        # Every part in flight may have all but one of its targets on here
+        self.replica_pool = ThreadPool(part_workers * (len(targets) - 1)) if len(targets) > 1 else None
+        self.slots = threading.Semaphore(part_workers)
+        self.started = time.time()
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        self.size += len(data)
+        self.sha256.update(data)
+        while self.buffered >= self.part_size:
+            chunk = "".join(self.buffer)
+            self.buffer = [chunk[self.part_size:]]
+            self.buffered = len(self.buffer[0])
+            self.send_part(chunk[:self.part_size])
+
+    def send_part(self, chunk):
+        if self.upload_ids is None:
+            self.upload_ids = [client.create_multipart_upload(Bucket=bucket_name, Key=self.key,
+                                                              **self.extra_args)['UploadId']
+                               for client, bucket_name in self.targets]
+        part_number = len(self.pending) + 1
+        if part_number > MAX_PARTS:
+            raise ValueError("%s is too big for %s byte parts" % (self.key, self.part_size))
+        
+        def upload_part(args):
+            try:
+                digest = md5(chunk).digest()
+                upload_ids = dict(zip(self.targets, self.upload_ids))
+                
+                def upload(client, bucket_name):
+                    response = client.upload_part(Bucket=bucket_name, Key=self.key,
+                                                  UploadId=upload_ids[(client, bucket_name)],
+                                                  PartNumber=part_number, Body=chunk,
+                                                  ContentMD5=base64.b64encode(digest))
+                    return response['ETag']
+                
+                return (digest, map_targets(upload, self.targets, self.replica_pool))
+            finally:
+                self.slots.release()
+        
+        # Block the writer rather than buffer the whole archive in memory
+        self.slots.acquire()
+        self.pending.append(self.pool.apply_async(upload_part, [None]))
+
+    def close(self):
+        try:
+            chunk = "".join(self.buffer)
+            if self.upload_ids is None:
+                # Never filled a part, a plain PUT will do
+                return _put_hashed(self.targets, self.key, chunk, self.extra_args, pool=self.replica_pool)
+            if chunk:
+                self.send_part(chunk)
+            parts = [p.get() for p in self.pending]
+            
+            results = []
+            etag = '"%s-%s"' % (md5("".join(digest for digest, _ in parts)).hexdigest(), len(parts))
+            for i, ((client, bucket_name), upload_id) in enumerate(zip(self.targets, self.upload_ids)):
+                client.complete_multipart_upload(Bucket=bucket_name, Key=self.key, UploadId=upload_id,
+                                                 MultipartUpload={'Parts': [{'PartNumber': n + 1, 'ETag': etags[i]}
+                                                                            for n, (_, etags) in enumerate(parts)]})
+                result = UploadResult(bucket_name, self.key, self.size, self.sha256.hexdigest(), etag,
+                                      region_name=client.meta.region_name)
+                (result.started, result.finished) = (self.started, time.time())
+                results.append(result)
+            return results
+        except:
+            self.abort()
+            raise
+        finally:
+            self.terminate()
+
+    def terminate(self):
+        self.pool.terminate()
+        if self.replica_pool is not None:
+            self.replica_pool.terminate()
+
+    def abort(self):
+        for (client, bucket_name), upload_id in zip(self.targets, self.upload_ids or []):
+            try:
+                client.abort_multipart_upload(Bucket=bucket_name, Key=self.key, UploadId=upload_id)
+            except ClientError, ex:
+                logging.warn("Unable to abort multipart upload of %s: %s" % (self.key, ex))
+        self.terminate()
+
+DeltaPart = namedtuple('DeltaPart', ['kind', 'offset', 'size', 'source_offset'])
+
+def plan_delta_parts(chunks, previous_chunks, part_size=PART_SIZE, min_part_size=MIN_PART_SIZE):
+    """
+    Turns an archive's chunks ({offset, size, sha256} dicts) into multipart
+    upload parts, given the chunks of an earlier upload. Chunks the earlier
+    upload has are 'copy' parts, copied server-side from source_offset,
+    the rest are 'send' parts. Copies too small to be a part are sent,
+    and a short send part borrows the start of the part after it.
+    """
+    previous = dict((c['sha256'], c) for c in previous_chunks)
+    runs = []
+    for chunk in chunks:
+        old = previous.get(chunk['sha256'])
+        if old is not None and old['size'] == chunk['size']:
+            (kind, source_offset) = ('copy', old['offset'])
+        else:
+            (kind, source_offset) = ('send', None)
+        last = runs[-1] if runs else None
+        if last and last[0] == kind and (kind == 'send' or last[3] + last[2] == source_offset):
+            last[2] += chunk['size']
+        else:
+            runs.append([kind, chunk['offset'], chunk['size'], source_offset])
+    
+    parts = []
+    for (kind, offset, size, source_offset) in runs:
+        prev = parts[-1] if parts else None
+        if prev and prev[0] == 'send' and prev[2] < min_part_size:
+            taken = min(size, min_part_size - prev[2])
+            prev[2] += taken
+            offset += taken
+            size -= taken
+            if source_offset is not None:
+                source_offset += taken
+        if size == 0:
+            continue
+        if kind == 'copy' and size < min_part_size:
+            (kind, source_offset) = ('send', None)
+        if kind == 'send' and prev and prev[0] == 'send':
+            prev[2] += size
+        else:
+            parts.append([kind, offset, size, source_offset])
+    
+    # Long runs of new data still go up in parallel
+    result = []
+    for (kind, offset, size, source_offset) in parts:
+        while kind == 'send' and size >= 2 * part_size:
+            result.append(DeltaPart(kind, offset, part_size, None))
+            offset += part_size
+            size -= part_size
+        result.append(DeltaPart(kind, offset, size, source_offset))
+    if len(result) > MAX_PARTS:
+        raise ValueError("%s parts is more than S3 allows" % len(result))
+    return result
+
+def upload_delta(client, bucket_name, key, filename, parts, source_key, source_etag,
+                 extra_args=None, part_workers=DEFAULT_PART_WORKERS):
+    """
+    Multipart upload of filename following plan_delta_parts: copy parts come
+    from source_key, as long as it still has source_etag, only send parts go
+    over the wire. Returns an UploadResult.
+    """
+    extra_args = extra_args or {}
+    with open(filename, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            sha256_digest = sha256(mm).hexdigest()
+            digests = [md5(mm[p.offset:p.offset + p.size]).digest() for p in parts]
+            etag = '"%s-%s"' % (md5("".join(digests)).hexdigest(), len(parts))
+            result = UploadResult(bucket_name, key, len(mm), sha256_digest, etag,
+                                  region_name=client.meta.region_name)
+            result.started = time.time()
+            upload_id = client.create_multipart_upload(Bucket=bucket_name, Key=key, **extra_args)['UploadId']
+            
+            def send_part(part_number):
+                part = parts[part_number - 1]
+                if part.kind == 'copy':
+                    response = client.upload_part_copy(Bucket=bucket_name, Key=key, UploadId=upload_id,
+                                                       PartNumber=part_number,
+                                                       CopySource={'Bucket': bucket_name, 'Key': source_key},
+                                                       CopySourceIfMatch=source_etag,
+                                                       CopySourceRange="bytes=%s-%s" % (
+                                                           part.source_offset, part.source_offset + part.size - 1))
+                    return response['CopyPartResult']['ETag']
+                response = client.upload_part(Bucket=bucket_name, Key=key, UploadId=upload_id,
+                                              PartNumber=part_number, Body=mm[part.offset:part.offset + part.size],
+                                              ContentMD5=base64.b64encode(digests[part_number - 1]))
+                return response['ETag']
+            
+            pool = ThreadPool(min(part_workers, len(parts)))
+            try:
+                etags = pool.map(send_part, range(1, len(parts) + 1))
+                client.complete_multipart_upload(Bucket=bucket_name, Key=key, UploadId=upload_id,
+                                                 MultipartUpload={'Parts': [{'PartNumber': n + 1, 'ETag': e}
+                                                                            for n, e in enumerate(etags)]})
+            except:
+                try:
+                    client.abort_multipart_upload(Bucket=bucket_name, Key=key, UploadId=upload_id)
+                except ClientError, ex:
+                    logging.warn("Unable to abort multipart upload of %s: %s" % (key, ex))
+                raise
+            finally:
+                pool.terminate()
+            result.finished = time.time()
+            return result
+        finally:
+            mm.close()
+
+class ConcurrencyTuner(object):
+    """
+    The concurrency limit for one size class of uploads. It climbs while
+    throughput improves and turns back when it drops, or when latency
+    balloons without throughput to show for it. Windows are only ever
+    compared with others of the same class.
+    """
+    def __init__(self, name, limit, min_workers, max_workers):
+        self.name = name
+        self.limit = limit
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.direction = 1
+        self.last_rate = None
+        self.min_latency = None
+        # Where the limit settles is what gets recorded, not one lucky window
+        self.recent_limits = deque(maxlen=5)
+
+    def adjust(self, rate, latency):
+        self.min_latency = latency if self.min_latency is None else min(self.min_latency, latency)
+        self.recent_limits.append(self.limit)
+        
+        step = max(1, self.limit // 4)
+        if self.last_rate is not None:
+            improved = rate > self.last_rate * 1.05
+            if rate < self.last_rate * 0.95 or (latency > 2 * self.min_latency and not improved):
+                self.direction = -self.direction
+            elif not improved:
+                # Flat, keep probing gently
+                step = 1
+        limit = max(self.min_workers, min(self.max_workers, self.limit + self.direction * step))
+        if limit != self.limit:
+            logging.debug("Upload concurrency for %s files %s -> %s (%.2f MB/s, %.3fs per upload)" % (
+                self.name, self.limit, limit, rate / 1048576.0, latency))
+        self.limit = limit
+        self.last_rate = rate
+
+    def get_workers(self):
+        if not self.recent_limits:
+            return None
+        return int(round(float(sum(self.recent_limits)) / len(self.recent_limits)))
+
+class UploadScheduler(object):
+    """
+    Runs uploads largest first, so a big file doesn't start last and hold up
+    the end of the deploy. When adaptive, an upload holds a slot per request
+    it has in flight (a multipart upload as many as it sends parts at once)
+    and each size class gets its own limit, tuned by a ConcurrencyTuner while
+    that class is running: a window of big files and one of small files
+    aren't comparable. Otherwise workers is simply the number of files in
+    flight. class_workers, {size class: limit}, overrides workers per class.
+    """
+    def __init__(self, max_workers, workers=None, min_workers=1, adaptive=True, window=2.0,
+                 multipart_threshold=MULTIPART_THRESHOLD, part_size=PART_SIZE, part_workers=DEFAULT_PART_WORKERS,
+                 class_workers=None):
+        self.max_workers = max_workers
+        self.min_workers = min(min_workers, max_workers)
+        self.adaptive = adaptive
+        self.window = window
+        self.multipart_threshold = multipart_threshold
+        self.part_size = part_size
+        self.part_workers = part_workers
+        class_workers = class_workers or {}
+        self.tuners = {}
+        for name in SIZE_CLASSES:
+            limit = class_workers.get(name) or workers or max_workers
+            self.tuners[name] = ConcurrencyTuner(name, max(self.min_workers, min(limit, max_workers)),
+                                                 self.min_workers, max_workers)
+        self.tuner = self.tuners[SIZE_CLASSES[0]]
+        self.in_flight = 0
+        self.total_bytes = 0
+        self.total_files = 0
+        self.elapsed = 0.0
+        self.cond = threading.Condition()
+        self.reset_window(time.time())
+
+    @property
+    def limit(self):
+        return self.tuner.limit
+
+    def reset_window(self, now):
+        self.window_start = now
+        self.window_bytes = 0
+        self.window_files = 0
+        self.window_latency = 0.0
+
+    def get_size_class(self, size):
+        if size >= self.multipart_threshold:
+            return 'large'
+        elif size >= SMALL_FILE_SIZE:
+            return 'medium'
+        return 'small'
+
+    def get_slots(self, size):
+        if not self.adaptive or size < self.multipart_threshold:
+            return 1
+        return min(self.part_workers, -(-size // self.part_size), self.max_workers)
+
+    def run(self, fn, items, size_of):
+        """
+        Calls fn(item) for every item, largest first by size_of(item). Once
+        fn raises nothing new is started, and the first exception is raised
+        when the uploads already running have finished.
+        """
+        sized = sorted(((size_of(item), item) for item in items), key=lambda s: -s[0])
+        errors = []
+        started = time.time()
+        pool = ThreadPool(self.max_workers)
+        try:
+            for size, item in sized:
+                slots = self.get_slots(size)
+                with self.cond:
+                    tuner = self.tuners[self.get_size_class(size)]
+                    if tuner is not self.tuner:
+                        # Largest first, so the last class is done starting
+                        self.tuner = tuner
+                        self.reset_window(time.time())
+                    # Something bigger than the limit still gets to run on its own
+                    while not errors and self.in_flight and self.in_flight + slots > self.tuner.limit:
+                        self.cond.wait()
+                    if errors:
+                        break
+                    self.in_flight += slots
+                pool.apply_async(self._call, (fn, item, size, slots, errors))
+            with self.cond:
+                while self.in_flight:
+                    self.cond.wait()
+        finally:
+            pool.terminate()
+            self.elapsed += time.time() - started
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+
+    def _call(self, fn, item, size, slots, errors):
+        start = time.time()
+        try:
+            fn(item)
+        except Exception:
+            with self.cond:
+                errors.append(sys.exc_info())
+        finally:
+            self.finished(size, slots, time.time() - start)
+
+    def finished(self, size, slots, latency):
+        with self.cond:
+            self.in_flight -= slots
+            self.total_bytes += size
+            self.total_files += 1
+            # Stragglers from the previous class don't count towards this one
+            if self.get_size_class(size) == self.tuner.name:
+                self.window_bytes += size
+                self.window_files += 1
+                self.window_latency += latency
+            now = time.time()
+            if self.adaptive and self.window_files and now - self.window_start >= self.window:
+                rate = (self.window_bytes + REQUEST_OVERHEAD_BYTES * self.window_files) / (now - self.window_start)
+                self.tuner.adjust(rate, self.window_latency / self.window_files)
+                self.reset_window(now)
+            self.cond.notify_all()
+
+    def get_settings(self):
+        """
+        What to start the next run with, None if no window was measured.
+        """
+        workers = dict((name, tuner.get_workers()) for name, tuner in self.tuners.items()
+                       if tuner.get_workers() is not None)
+        if not workers:
+            return None
+        return {'workers': workers,
+                'bytes_per_second': int(self.total_bytes / max(self.elapsed, 0.001))}
+
+    def log_summary(self, name):
+        settings = self.get_settings()
+        if settings:
+            concurrency = ", ".join("%s=%s" % (c, settings['workers'][c]) for c in SIZE_CLASSES
+                                    if c in settings['workers'])
+        else:
+            concurrency = self.limit
+        logging.info("%s: %s files, %.1f MB in %.1fs, %.2f MB/s, concurrency settled at %s" % (
+            name, self.total_files, self.total_bytes / 1048576.0, self.elapsed,
+            self.total_bytes / 1048576.0 / max(self.elapsed, 0.001), concurrency))
+
+def verify_uploads(aws, results, workers=DEFAULT_MAX_WORKERS):
+    """
+    HEADs every uploaded object in parallel and checks its ETag and size
+    against what we computed while uploading.
+    """
+    def verify(result):
+        try:
+            head = aws.client('s3', region_name=result.region_name).head_object(Bucket=result.bucket_name,
+                                                                                Key=result.key)
+            result.actual_etag = head['ETag']
+            result.verified = (head['ETag'] == result.etag and head['ContentLength'] == result.size)
+        except ClientError, ex:
+            result.verified = False
+            result.error = str(ex)
+        return result
+    
+    if not results:
+        return []
+    pool = ThreadPool(min(workers, len(results)))
+    try:
+        return pool.map(verify, results)
+    finally:
+        pool.terminate()
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""
+Reproducible, parallel-compressed release archives.
+
+The "parallel" build backend writes the same files setuptools' sdist would,
+but as a deterministic tar (sorted entries, fixed mtimes, no owners) through
+a pigz-style gzip writer that deflates blocks on a thread pool. The same
+sources always give a byte-identical .tar.gz, whatever the thread timing,
+and the archive is written straight to any file-like sink, such as a
+deployaws.MultipartUploadStream.
+
+A chunked archive is also cut into chunks at file boundaries chosen from the
+file names, each compressed on its own. Its top-level directory carries no
+version and the metadata (which does) goes last in a chunk of its own, so a
+chunk that holds the same files as one in the previous release compresses to
+the same bytes, which is what lets a delta upload copy it rather than send it
+again.
+"""
+
+import os
+import zlib
+import struct
+import tarfile
+import posixpath
+import multiprocessing
+from hashlib import sha256
+from StringIO import StringIO
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+from setuptools import setup
+
+BLOCK_SIZE = 1024 * 1024
+DEFAULT_LEVEL = 6
+# Uncompressed chunk sizes, a chunk ends on a file whose name matches the mask
+# once it's past the minimum
+CHUNK_MIN_SIZE = 16 * 1024 * 1024
+CHUNK_MAX_SIZE = 128 * 1024 * 1024
+CHUNK_BOUNDARY_MASK = 0x7
+
+def get_source_date_epoch():
+    """
+    mtime for every archive entry, SOURCE_DATE_EPOCH if it's set.
+    """
+    try:
+        return int(os.environ.get('SOURCE_DATE_EPOCH', 0))
+    except ValueError:
+        return 0
+
+def get_sdist_files(setup_kwargs):
+    """
+    Runs egg_info (which is what sdist does first) and returns the list of
+    files sdist would have put in the archive, plus {arcname: content} for
+    the metadata: the PKG-INFO sdist writes and the .egg-info directory,
+    read now since the next egg_info run rewrites it.
+    """
+    dist = setup(script_name="setup.py", script_args=["egg_info"], **setup_kwargs)
+    egg_info = dist.get_command_obj('egg_info')
+    egg_info_dir = os.path.normpath(egg_info.egg_info) + os.path.sep
+    metadata = {}
+    files = []
+    for f in sorted(set(f for f in egg_info.filelist.files if os.path.isfile(f))):
+        if os.path.normpath(f).startswith(egg_info_dir):
+            with open(f, 'rb') as fh:
+                metadata[f.replace(os.path.sep, '/')] = fh.read()
+        else:
+            files.append(f)
+    pkg_info = StringIO()
+    dist.metadata.write_pkg_file(pkg_info)
+    metadata['PKG-INFO'] = pkg_info.getvalue()
+    return (dist.get_fullname(), files, metadata)
+
+class ParallelGzipWriter(object):
+    """
+    File-like gzip writer. Input is cut into fixed-size blocks which are
+    deflated independently on a thread pool (zlib lets go of the GIL) and
+    written out in order, each ending on a sync flush so the concatenation is
+    one valid deflate stream. Blocks don't share a dictionary, which costs
+    a little compression for a lot of speed.
+    """
+    def __init__(self, fileobj, workers=None, level=DEFAULT_LEVEL, block_size=BLOCK_SIZE):
+        self.fileobj = fileobj
+        self.level = level
+        self.block_size = block_size
+        self.workers = workers or multiprocessing.cpu_count()
+        self.pool = ThreadPool(self.workers)
+        self.pending = deque()
+        self.buffer = []
+        self.buffered = 0
+        self.crc = 0
+        self.size = 0
+        # No name and no mtime, so the header is always the same
+        self.fileobj.write(struct.pack("<BBBBIBB", 0x1f, 0x8b, 8, 0, 0, 0, 255))
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        if self.buffered >= self.block_size:
+            data = "".join(self.buffer)
+            end = len(data) - len(data) % self.block_size
+            for offset in range(0, end, self.block_size):
+                self.submit(data[offset:offset + self.block_size], last=False)
+            self.buffer = [data[end:]]
+            self.buffered = len(self.buffer[0])
+
+    def tell(self):
+        return self.size
+
+    def flush(self):
+        """
+        Ends the current block early and waits until everything written so
+        far has reached fileobj. What's written next starts a fresh block.
+        """
+        if self.buffered:
+            self.submit("".join(self.buffer), last=False)
+            self.buffer = []
+            self.buffered = 0
+        while self.pending:
+            self.fileobj.write(self.pending.popleft().get())
+
+    def submit(self, block, last):
+        self.pending.append(self.pool.apply_async(deflate_block, (block, self.level, last)))
+        # Keep a bounded number of blocks in memory
+        while len(self.pending) > self.workers * 2:
+            self.fileobj.write(self.pending.popleft().get())
+
+    def close(self):
+        try:
+            self.submit("".join(self.buffer), last=True)
+            while self.pending:
+                self.fileobj.write(self.pending.popleft().get())
+            self.fileobj.write(struct.pack("<II", self.crc & 0xffffffff, self.size & 0xffffffff))
+        finally:
+            self.pool.terminate()
+
+def deflate_block(block, level, last):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+class ChunkRecorder(object):
+    """
+    Passes writes through to fileobj, recording the offset, size and SHA-256
+    of each chunk cut() marks the end of.
+    """
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.offset = 0
+        self.start = 0
+        self.hash = sha256()
+        self.chunks = []
+
+    def write(self, data):
+        self.fileobj.write(data)
+        self.hash.update(data)
+        self.offset += len(data)
+
+    def cut(self):
+        if self.offset > self.start:
+            self.chunks.append({'offset': self.start, 'size': self.offset - self.start,
+                                'sha256': self.hash.hexdigest()})
+        self.start = self.offset
+        self.hash = sha256()
+
+def is_chunk_boundary(arcname, chunk_size):
+    if chunk_size >= CHUNK_MAX_SIZE:
+        return True
+    return chunk_size >= CHUNK_MIN_SIZE and zlib.crc32(arcname) & CHUNK_BOUNDARY_MASK == 0
+
+def make_tarinfo(arcname, mode, size=0, mtime=0, type=tarfile.REGTYPE):
+    info = tarfile.TarInfo(arcname)
+    info.type = type
+    info.mode = mode
+    info.size = size
+    info.mtime = mtime
+    info.uid = info.gid = 0
+    info.uname = info.gname = ''
+    return info
+
+def get_parents(arcnames):
+    parents = set()
+    for arcname in arcnames:
+        parent = posixpath.dirname(arcname)
+        while parent and parent not in parents:
+            parents.add(parent)
+            parent = posixpath.dirname(parent)
+    return parents
+
+def write_reproducible_tar(fileobj, base_dir, files, extra_files=None, mtime=0, before_entry=None):
+    """
+    Writes files (paths relative to the current directory) under base_dir,
+    sorted, with every directory entry, then extra_files ({arcname: content})
+    and the directories only they are in. before_entry(arcname, extra) is
+    called before each entry is written.
+    """
+    extra_files = extra_files or {}
+    entries = dict((posixpath.join(base_dir, f.replace(os.path.sep, '/')), f) for f in files)
+    file_dirs = get_parents(entries)
+    extras = set(posixpath.join(base_dir, name) for name in extra_files)
+    entries.update((arcname, None) for arcname in extras)
+    dirs = get_parents(entries)
+    extras |= dirs - file_dirs
+
+    tar = tarfile.open(fileobj=fileobj, mode='w', format=tarfile.GNU_FORMAT)
+    try:
+        for arcname in sorted(set(entries) | dirs, key=lambda arcname: (arcname in extras, arcname)):
+            if before_entry is not None:
+                before_entry(arcname, arcname in extras)
+            if arcname in dirs:
+                tar.addfile(make_tarinfo(arcname, 0755, mtime=mtime, type=tarfile.DIRTYPE))
+            elif entries[arcname] is None:
+                content = extra_files[posixpath.relpath(arcname, base_dir)]
+                tar.addfile(make_tarinfo(arcname, 0644, len(content), mtime), StringIO(content))
+            else:
+                path = entries[arcname]
+                st = os.stat(path)
+                mode = 0755 if st.st_mode & 0111 else 0644
+                with open(path, 'rb') as f:
+                    tar.addfile(make_tarinfo(arcname, mode, st.st_size, mtime), f)
+    finally:
+        tar.close()
+
+def write_release_archive(fileobj, fullname, files, metadata, workers=None, level=DEFAULT_LEVEL, chunked=False,
+                          base_dir=None):
+    """
+    Writes the .tar.gz sdist would have built to fileobj, given what
+    get_sdist_files returned, under base_dir if given rather than fullname.
+    A chunked archive returns its chunks, and wants a base_dir that stays the
+    same from one version to the next.
+    """
+    base_dir = base_dir or fullname
+    if not chunked:
+        gz = ParallelGzipWriter(fileobj, workers=workers, level=level)
+        write_reproducible_tar(gz, base_dir, files, metadata, mtime=get_source_date_epoch())
+        gz.close()
+        return None
+    
+    recorder = ChunkRecorder(fileobj)
+    gz = ParallelGzipWriter(recorder, workers=workers, level=level)
+    state = {'start': 0, 'extra': False}
+    
+    def before_entry(arcname, extra):
+        # Boundaries only depend on the name within the archive, and the
+        # metadata starts a chunk of its own
+        name = posixpath.relpath(arcname, base_dir)
+        size = gz.tell() - state['start']
+        if size and ((extra and not state['extra']) or (not extra and is_chunk_boundary(name, size))):
+            gz.flush()
+            recorder.cut()
+            state['start'] = gz.tell()
+        state['extra'] = extra
+    
+    write_reproducible_tar(gz, base_dir, files, metadata, mtime=get_source_date_epoch(),
+                           before_entry=before_entry)
+    gz.close()
+    recorder.cut()
+    return recorder.chunks
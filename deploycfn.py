@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+Planning CloudFormation stack parameters.
+
+Rather than re-sending every parameter the stack already has, the desired
+parameters are diffed against the stack's current ones: only added and
+changed values are sent, everything else goes as UsePreviousValue. That also
+keeps NoEcho parameters intact, since describe_stacks only ever shows them
+as asterisks.
+"""
+
+import logging
+
+from botocore.exceptions import ClientError
+
+from deployaws import call_with_retries
+from deploylib import DeployException
+
+NO_ECHO_VALUE = '****'
+MAX_DISPLAY_LENGTH = 60
+
+def get_error_message(ex):
+    return ex.response.get('Error', {}).get('Message', '')
+
+def is_stack_missing(ex):
+    return (ex.response.get('Error', {}).get('Code') == 'ValidationError'
+            and 'does not exist' in get_error_message(ex))
+
+def is_no_op_update(ex):
+    return 'No updates are to be performed' in get_error_message(ex)
+
+def describe_stack(cfn_client, stack_name):
+    """
+    The stack, or None if there's no stack by that name. Transient errors
+    are retried, anything else is raised rather than taken as a missing
+    stack.
+    """
+    try:
+        response = call_with_retries(lambda: cfn_client.describe_stacks(StackName=stack_name),
+                                     description="Describing stack %s" % stack_name)
+    except ClientError, ex:
+        if is_stack_missing(ex):
+            return None
+        raise
+    stacks = response['Stacks']
+    if len(stacks) != 1:
+        raise DeployException("Expected one stack named %s, found %s" % (stack_name, len(stacks)))
+    return stacks[0]
+
+def get_template_parameters(cfn_client, template_url):
+    """
+    {parameter name: whether it's NoEcho} for the template at template_url.
+    """
+    summary = call_with_retries(lambda: cfn_client.get_template_summary(TemplateURL=template_url),
+                                description="Summarizing template %s" % template_url)
+    return dict((p['ParameterKey'], p.get('NoEcho', False)) for p in summary.get('Parameters', []))
+
+def to_parameter_value(value):
+    # Strings as they are, str() would fail on non-ASCII unicode
+    if isinstance(value, basestring):
+        return value
+    return str(value)
+
+def format_value(value):
+    value = to_parameter_value(value)
+    if len(value) > MAX_DISPLAY_LENGTH:
+        return value[:MAX_DISPLAY_LENGTH - 3] + "..."
+    return value
+
+class StackParameterPlan(object):
+    """
+    current is the stack's parameters ({} for a new stack), desired the ones
+    this deploy sets, declared get_template_parameters' result if known.
+    Current parameters the template no longer declares are dropped.
+    """
+    def __init__(self, current, desired, declared=None):
+        self.declared = declared or {}
+        self.added = {}
+        self.changed = {}
+        self.unchanged = []
+        self.kept = []
+        self.removed = []
+
+        for key, value in desired.items():
+            value = to_parameter_value(value)
+            if key not in current:
+                self.added[key] = value
+            elif current[key] == NO_ECHO_VALUE or current[key] != value:
+                # A NoEcho value can't be compared, so it's always sent
+                self.changed[key] = (current[key], value)
+            else:
+                self.unchanged.append(key)
+        for key in current:
+            if key in desired:
+                continue
+            if declared is not None and key not in declared:
+                self.removed.append(key)
+            else:
+                self.kept.append(key)
+
+    def to_cfn_params(self):
+        params = [{'ParameterKey': key, 'ParameterValue': value}
+                  for key, value in sorted(self.added.items())]
+        params += [{'ParameterKey': key, 'ParameterValue': new}
+                   for key, (_, new) in sorted(self.changed.items())]
+        params += [{'ParameterKey': key, 'UsePreviousValue': True}
+                   for key in sorted(self.unchanged + self.kept)]
+        return params
+
+    def is_secret(self, key, current_value=None):
+        return self.declared.get(key, False) or current_value == NO_ECHO_VALUE
+
+    def log_summary(self, stack_name):
+        logging.info("Parameters for stack %s: %s added, %s changed, %s removed, %s unchanged" % (
+            stack_name, len(self.added), len(self.changed), len(self.removed),
+            len(self.unchanged) + len(self.kept)))
+        for key, value in sorted(self.added.items()):
+            logging.info("  + %s: %s" % (key, NO_ECHO_VALUE if self.is_secret(key) else format_value(value)))
+        for key, (old, new) in sorted(self.changed.items()):
+            if self.is_secret(key, old):
+                (old, new) = (NO_ECHO_VALUE, NO_ECHO_VALUE)
+            logging.info("  ~ %s: %s -> %s" % (key, format_value(old), format_value(new)))
+        for key in sorted(self.removed):
+            logging.info("  - %s" % key)
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+"""
+Deploy configuration loading and validation.
+
+The deploy YAML and the per-stack <stack>-deploy.yaml files are parsed once
+per run into a DeployConfig, with the values the deployer needs over and over
+(bucket names, exclusion paths, template paths) computed up front. Parsed
+files are cached on disk keyed by mtime/size and content hash so repeated
+invocations don't have to parse YAML at all.
+"""
+
+import os
+import copy
+import logging
+import cPickle as pickle
+from hashlib import sha1
+
+import yaml
+
+try:
+    YAML_LOADER = yaml.CSafeLoader
+except AttributeError:
+    YAML_LOADER = yaml.SafeLoader
+
+DEFAULT_CACHE_ROOT = './.deploy-cache'
+# Not staticfiles.json, which Django's ManifestStaticFilesStorage writes into the static root
+DEFAULT_STATIC_MANIFEST_NAME = '.deploy-manifest.json'
+DEFAULT_UPLOAD_WORKERS = 10
+STATIC_LAYOUTS = ('per-release', 'content-addressed')
+BUILD_BACKENDS = ('sdist', 'parallel')
+
+class DeployConfigError(Exception):
+    pass
+
+# key: (type(s), required)
+CONFIG_SCHEMA = {
+    'static-bucket-format': (basestring, True),
+    'app-bucket-format': (basestring, True),
+    'app-releases-path': (basestring, True),
+    'cfn-template-releases-path': (basestring, True),
+    'root-template-name': (basestring, True),
+    'cfn-template-root-path': (list, True),
+    'template-parameter-names': (dict, True),
+    'setup-parameters': (dict, True),
+    'static-src-root': (basestring, False),
+    'static-prefix': (basestring, False),
+    'static-folder-exclusions': (list, False),
+    'stack-vars-root': (basestring, False),
+    'nested-stack-templates': (list, False),
+    'db-migrator': (basestring, False),
+    'db-migrator-timeout': ((int, long), False),
+    'db-migrator-watch-paths': (list, False),
+    'deploy-cache-root': (basestring, False),
+    'pre-deploy-hook-root': (basestring, False),
+    'pre-deploy-hooks': (dict, False),
+    'pre-deploy-hook-timeout': ((int, long), False),
+    'aws-region': (basestring, False),
+    'upload-workers': ((int, long), False),
+    'rate-limits': (dict, False),
+    'static-layout': (basestring, False),
+    'static-pool-dir': (basestring, False),
+    'static-stable-names': (list, False),
+    'static-manifest-name': (basestring, False),
+    'verify-uploads': (bool, False),
+    'static-replicas': (list, False),
+    'metrics-textfile': (basestring, False),
+    'build-backend': (basestring, False),
+    'build-compress-workers': ((int, long), False),
+    'build-compress-level': ((int, long), False),
+    'app-delta-upload': (bool, False),
+    'upload-autotune': (bool, False),
+}
+
+SETUP_PARAMETERS_SCHEMA = {
+    'author-name': (basestring, True),
+    'author-email': (basestring, True),
+    'product-url': (basestring, True),
+    'search-path-exclusions': (list, False),
+    'console-scripts': (dict, False),
+}
+
+def validate(conf, schema, source):
+    if not isinstance(conf, dict):
+        raise DeployConfigError("%s: expected a mapping at the top level, got %s" % (source, type(conf).__name__))
+
+    errors = []
+    for key, (types, required) in sorted(schema.items()):
+        if key not in conf or conf[key] is None:
+            if required:
+                errors.append("missing required key [%s]" % key)
+        elif not isinstance(conf[key], types):
+            errors.append("key [%s] should be %s, got %s" % (key, getattr(types, '__name__', types),
+                                                              type(conf[key]).__name__))
+    if errors:
+        raise DeployConfigError("%s is not valid:\n\t%s" % (source, "\n\t".join(errors)))
+
+    for key in sorted(conf):
+        if key not in schema:
+            logging.warn("%s: unknown config key [%s], ignoring." % (source, key))
+
+class ConfigCache(object):
+    """
+    Caches parsed YAML files in memory and under <cache_root>/config. An entry
+    is reused when the file's mtime and size match, or failing that when its
+    sha1 does (e.g. after a fresh checkout touched every file). Loads without
+    a cache_root stay in memory.
+    """
+    def __init__(self):
+        self.entries = {}
+
+    def get_entry_path(self, path, cache_root):
+        return os.path.join(cache_root, 'config', "%s.pickle" % sha1(os.path.abspath(path)).hexdigest())
+
+    def read_entry(self, path, cache_root=None):
+        abspath = os.path.abspath(path)
+        if abspath in self.entries or cache_root is None:
+            return self.entries.get(abspath)
+        try:
+            with open(self.get_entry_path(path, cache_root), 'rb') as f:
+                return pickle.load(f)
+        except Exception:
+            return None
+
+    def write_entry(self, path, entry, cache_root=None):
+        self.entries[os.path.abspath(path)] = entry
+        if cache_root is None:
+            return
+        entry_path = self.get_entry_path(path, cache_root)
+        try:
+            if not os.path.isdir(os.path.dirname(entry_path)):
+                os.makedirs(os.path.dirname(entry_path))
+            tmp_path = "%s.%s.tmp" % (entry_path, os.getpid())
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, entry_path)
+        except (IOError, OSError), ex:
+            logging.warn("Unable to write config cache for %s: %s" % (path, ex))
+
+    def load(self, path, cache_root=None):
+        st = os.stat(path)
+        entry = self.read_entry(path, cache_root)
+        if entry and entry['mtime'] == st.st_mtime and entry['size'] == st.st_size:
+            return copy.deepcopy(entry['data'])
+
+        with open(path, 'rb') as f:
+            content = f.read()
+        digest = sha1(content).hexdigest()
+
+        if entry and entry['sha1'] == digest:
+            data = entry['data']
+        else:
+            data = yaml.load(content, Loader=YAML_LOADER)
+
+        self.write_entry(path, {
+            'mtime': st.st_mtime,
+            'size': st.st_size,
+            'sha1': digest,
+            'data': data
+        }, cache_root)
+        return copy.deepcopy(data)
+
+class DeployConfig(object):
+    """
+    A validated deploy config for a single stack. The raw parsed dict stays
+    available as `raw` for hooks and anything else that wants it.
+    """
+    def __init__(self, raw, stack_name, stack_vars=None, source=None):
+        self.raw = raw
+        self.stack_name = stack_name
+        self.stack_vars = stack_vars or {}
+        self.source = source
+
+        fmt_args = {'stack_name': stack_name}
+        self.app_bucket_name = raw['app-bucket-format'] % fmt_args
+        self.static_bucket_name = raw['static-bucket-format'] % fmt_args
+        self.app_releases_path = raw['app-releases-path']
+        self.template_releases_path = raw['cfn-template-releases-path']
+        self.static_prefix = raw.get('static-prefix')
+        self.static_src_root = raw.get('static-src-root')
+        self.db_migrator = raw.get('db-migrator')
+        self.cache_root = raw.get('deploy-cache-root', DEFAULT_CACHE_ROOT)
+        self.aws_region = raw.get('aws-region')
+        self.upload_workers = raw.get('upload-workers', DEFAULT_UPLOAD_WORKERS)
+        self.rate_limits = raw.get('rate-limits') or {}
+        self.metrics_textfile = raw.get('metrics-textfile')
+        self.build_backend = raw.get('build-backend', 'sdist')
+        self.build_compress_workers = raw.get('build-compress-workers')
+        self.build_compress_level = raw.get('build-compress-level', 6)
+        self.app_delta_upload = raw.get('app-delta-upload', False)
+        self.upload_autotune = raw.get('upload-autotune', True)
+        self.template_parameter_names = raw['template-parameter-names']
+        self.setup_parameters = raw['setup-parameters']
+
+        self.template_root_path_parts = raw['cfn-template-root-path']
+        self.root_template_path = os.path.join(*(self.template_root_path_parts + [raw['root-template-name']]))
+        self.nested_template_paths = []
+        for nsf in raw.get('nested-stack-templates') or []:
+            self.nested_template_paths.append((nsf, os.path.join(*(self.template_root_path_parts + [nsf]))))
+
+        self.static_folder_exclusions = raw.get('static-folder-exclusions') or []
+        self.static_layout = raw.get('static-layout', 'per-release')
+        self.static_pool_dir = raw.get('static-pool-dir', '_pool')
+        self.static_stable_names = raw.get('static-stable-names') or ['*.html']
+        self.static_manifest_name = raw.get('static-manifest-name', DEFAULT_STATIC_MANIFEST_NAME)
+        self.verify_uploads = raw.get('verify-uploads', True)
+        # (region, bucket name) for every bucket a static release goes to,
+        # the primary first
+        self.static_replicas = [(r['region'], r['bucket-format'] % fmt_args)
+                                for r in raw.get('static-replicas') or []]
+        self.static_targets = [(self.aws_region, self.static_bucket_name)] + self.static_replicas
+        self.set_static_src_root(self.static_src_root)
+
+    def set_static_src_root(self, static_src_root):
+        self.static_src_root = static_src_root
+        if static_src_root:
+            self.static_exclusion_paths = frozenset(os.path.join(static_src_root, x)
+                                                    for x in self.static_folder_exclusions)
+        else:
+            self.static_exclusion_paths = frozenset()
+
+    def __getitem__(self, key):
+        return self.raw[key]
+
+    def __contains__(self, key):
+        return key in self.raw
+
+    def get(self, key, default=None):
+        return self.raw.get(key, default)
+
+    @classmethod
+    def load(cls, config_path, stack_name, cache=None):
+        if not (os.path.exists(config_path) and os.path.isfile(config_path)):
+            raise DeployConfigError("Config path %s is not valid" % config_path)
+
+        cache = cache or ConfigCache()
+        try:
+            # The deploy config is what names deploy-cache-root, so it's
+            # always cached under the default root
+            raw = cache.load(config_path, DEFAULT_CACHE_ROOT)
+        except yaml.YAMLError, ex:
+            raise DeployConfigError("Config path %s could not be loaded because: %s" % (config_path, ex))
+        validate(raw, CONFIG_SCHEMA, config_path)
+        validate(raw['setup-parameters'], SETUP_PARAMETERS_SCHEMA, "%s setup-parameters" % config_path)
+        if raw.get('static-layout', STATIC_LAYOUTS[0]) not in STATIC_LAYOUTS:
+            raise DeployConfigError("%s: static-layout should be one of %s" % (config_path, ", ".join(STATIC_LAYOUTS)))
+        if raw.get('build-backend', BUILD_BACKENDS[0]) not in BUILD_BACKENDS:
+            raise DeployConfigError("%s: build-backend should be one of %s" % (config_path, ", ".join(BUILD_BACKENDS)))
+        if raw.get('app-delta-upload') and raw.get('build-backend') != 'parallel':
+            raise DeployConfigError("%s: app-delta-upload needs build-backend: parallel" % config_path)
+        for replica in raw.get('static-replicas') or []:
+            if not isinstance(replica, dict) or 'region' not in replica or 'bucket-format' not in replica:
+                raise DeployConfigError("%s: every static-replicas entry needs a region and a bucket-format" % config_path)
+
+        ### Load stack-specific vars, cached under the root the loaded config names
+        stack_vars = {}
+        if 'stack-vars-root' in raw:
+            stack_vars_path = os.path.join(raw['stack-vars-root'], "%s-deploy.yaml" % stack_name)
+            if os.path.exists(stack_vars_path):
+                conf_dict = cache.load(stack_vars_path, raw.get('deploy-cache-root', DEFAULT_CACHE_ROOT))
+                vars_key = '%s-vars' % stack_name
+                if not isinstance(conf_dict, dict) or vars_key not in conf_dict:
+                    raise DeployConfigError("%s is missing the [%s] key" % (stack_vars_path, vars_key))
+                stack_vars = conf_dict[vars_key] or {}
+                for key, val_dict in stack_vars.items():
+                    if not isinstance(val_dict, dict) or 'value' not in val_dict or 'type' not in val_dict:
+                        raise DeployConfigError("%s: stack var [%s] needs both a value and a type" % (stack_vars_path, key))
+            else:
+                logging.warn("Could not find path for stack-specific variables: %s" % stack_vars_path)
+
+        return cls(raw, stack_name, stack_vars, source=config_path)
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Long-running deploy daemon.
+
+Started once in a checkout, it keeps what every deploy.py run would otherwise
+pay for again warm: the interpreter and boto3 imports, AWS client pools (with
+their credentials and connections), parsed config files, the CloudFront
+distribution index, the static file hash index and git's view of HEAD.
+
+Jobs are deploy.py command lines sent over a Unix socket as one JSON line:
+
+    {"argv": ["--deploy-app", "stage"], "cwd": "/path/to/checkout"}
+
+Jobs for the same stack run one after the other, different stacks run
+concurrently up to --max-jobs. Progress is streamed back as JSON lines,
+ending with {"event": "done", "status": <exit status>}.
+
+    python deployd.py serve &
+    python deployd.py submit -- --deploy-app --update-distro stage
+"""
+
+import os
+import sys
+import json
+import socket
+import logging
+import threading
+import Queue
+import SocketServer
+from contextlib import closing
+from argparse import ArgumentParser, REMAINDER
+
+DEFAULT_SOCKET_PATH = './.deploy-cache/deployd.sock'
+DEFAULT_MAX_JOBS = 4
+
+class WarmState(object):
+    """
+    Everything shared between the deploys a daemon runs. Client pools are
+    leased to one deploy at a time, with that deploy's observers attached.
+    """
+    def __init__(self):
+        from deployconfig import ConfigCache
+        from deploylib import FileHashIndex
+        self.config_cache = ConfigCache()
+        self.dist_index = {}
+        self.hash_index = FileHashIndex()
+        self.git_cache = {}
+        self.idle_pools = {}
+        self.lock = threading.Lock()
+
+    def get_pool_key(self, config):
+        return (config.aws_region, config.upload_workers)
+
+    def checkout_client_pool(self, config, observers):
+        from deployaws import ClientPool
+        key = self.get_pool_key(config)
+        with self.lock:
+            idle = self.idle_pools.get(key)
+            pool = idle.pop() if idle else None
+        if pool is None:
+            return ClientPool(max_workers=config.upload_workers, region_name=config.aws_region,
+                              observers=observers)
+        pool.set_observers(observers)
+        return pool
+
+    def checkin_client_pool(self, config, pool):
+        pool.set_observers([])
+        with self.lock:
+            self.idle_pools.setdefault(self.get_pool_key(config), []).append(pool)
+
+class DeployJob(object):
+    def __init__(self, job_id, stack_name, args):
+        self.job_id = job_id
+        self.stack_name = stack_name
+        self.args = args
+        self.events = Queue.Queue()
+        self.status = None
+
+    def send(self, event, **data):
+        data['event'] = event
+        data['job'] = self.job_id
+        self.events.put(data)
+
+class JobLogHandler(logging.Handler):
+    """
+    Streams log records to the job running on the thread that logged them.
+    Records from a deploy's worker pools only go to the daemon's own log.
+    """
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+        self.jobs = {}
+
+    def bind(self, job):
+        self.jobs[threading.current_thread().ident] = job
+
+    def unbind(self):
+        self.jobs.pop(threading.current_thread().ident, None)
+
+    def emit(self, record):
+        job = self.jobs.get(record.thread)
+        if job is not None:
+            try:
+                job.send('log', level=record.levelname, message=self.format(record))
+            except Exception:
+                self.handleError(record)
+
+class DeployScheduler(object):
+    def __init__(self, warm, max_jobs=DEFAULT_MAX_JOBS):
+        self.warm = warm
+        self.slots = threading.Semaphore(max_jobs)
+        self.queues = {}
+        self.next_job_id = 1
+        self.lock = threading.Lock()
+        self.log_handler = JobLogHandler()
+        logging.getLogger().addHandler(self.log_handler)
+
+    def submit(self, args):
+        with self.lock:
+            job = DeployJob(self.next_job_id, args.stack_name, args)
+            self.next_job_id += 1
+            queue = self.queues.get(job.stack_name)
+            if queue is None:
+                queue = self.queues[job.stack_name] = Queue.Queue()
+                worker = threading.Thread(target=self.work, args=(queue,),
+                                          name="deployd-%s" % job.stack_name)
+                worker.daemon = True
+                worker.start()
+            job.send('queued', stack=job.stack_name, ahead=queue.qsize())
+            queue.put(job)
+        return job
+
+    def work(self, queue):
+        while True:
+            job = queue.get()
+            with self.slots:
+                self.run_job(job)
+
+    def run_job(self, job):
+        import deploy
+        job.send('started')
+        self.log_handler.bind(job)
+        try:
+            job.status = deploy.run(job.args, warm=self.warm)
+        except SystemExit, ex:
+            job.status = ex.code if isinstance(ex.code, int) else 1
+        except Exception:
+            logging.exception("Deploy job %s for stack %s failed" % (job.job_id, job.stack_name))
+            job.status = 1
+        finally:
+            self.log_handler.unbind()
+            job.send('done', status=job.status)
+
+class DeployRequestHandler(SocketServer.StreamRequestHandler):
+    def write_event(self, data):
+        try:
+            self.wfile.write(json.dumps(data) + "\n")
+            self.wfile.flush()
+            return True
+        except (IOError, socket.error):
+            # The client went away, the job carries on regardless
+            return False
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+        except ValueError:
+            self.write_event({'event': 'error', 'message': "Expected a JSON job on one line"})
+            return
+
+        if os.path.realpath(request.get('cwd') or '.') != os.path.realpath(os.getcwd()):
+            self.write_event({'event': 'error', 'message': "deployd serves %s, not %s" % (
+                os.getcwd(), request.get('cwd'))})
+            return
+
+        import deploy
+        try:
+            args = deploy.make_arg_parser().parse_args(request.get('argv') or [])
+        except SystemExit:
+            self.write_event({'event': 'error', 'message': "Invalid deploy arguments: %s" % request.get('argv')})
+            return
+
+        job = self.server.scheduler.submit(args)
+        connected = True
+        while True:
+            event = job.events.get()
+            if connected:
+                connected = self.write_event(event)
+            if event['event'] == 'done':
+                break
+
+class DeployServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, scheduler):
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        if not os.path.isdir(os.path.dirname(socket_path) or '.'):
+            os.makedirs(os.path.dirname(socket_path))
+        SocketServer.UnixStreamServer.__init__(self, socket_path, DeployRequestHandler)
+        os.chmod(socket_path, 0600)
+        self.scheduler = scheduler
+
+def serve(socket_path, max_jobs):
+    # Pay for the imports up front rather than on the first job
+    import deploy
+    server = DeployServer(socket_path, DeployScheduler(WarmState(), max_jobs))
+    logging.info("deployd serving %s on %s" % (os.getcwd(), socket_path))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
+    return 0
+
+def submit(socket_path, argv):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except socket.error, ex:
+        print >> sys.stderr, "Unable to connect to deployd on %s: %s" % (socket_path, ex)
+        return 1
+
+    with closing(sock), closing(sock.makefile('rwb')) as f:
+        f.write(json.dumps({'argv': argv, 'cwd': os.getcwd()}) + "\n")
+        f.flush()
+        for line in f:
+            event = json.loads(line)
+            if event['event'] == 'log':
+                print >> sys.stderr, event['message']
+            elif event['event'] == 'queued':
+                print >> sys.stderr, "Job %s queued for stack %s behind %s other jobs" % (
+                    event['job'], event['stack'], event['ahead'])
+            elif event['event'] == 'error':
+                print >> sys.stderr, event['message']
+                return 1
+            elif event['event'] == 'done':
+                return event['status']
+    print >> sys.stderr, "deployd closed the connection before the job finished"
+    return 1
+
+if __name__ == "__main__":
+    arg_parser = ArgumentParser("Run deploys from a long-running daemon.")
+    arg_parser.add_argument("--socket", default=DEFAULT_SOCKET_PATH, help="Unix socket the daemon listens on.")
+    subparsers = arg_parser.add_subparsers(dest="command")
+    serve_parser = subparsers.add_parser("serve", help="Start the daemon in the current checkout.")
+    serve_parser.add_argument("--max-jobs", type=int, default=DEFAULT_MAX_JOBS,
+                              help="How many stacks to deploy at once.")
+    submit_parser = subparsers.add_parser("submit", help="Run a deploy.py command line on the daemon.")
+    submit_parser.add_argument("argv", nargs=REMAINDER)
+    args = arg_parser.parse_args()
+
+    if args.command == "serve":
+        logging.basicConfig(level=logging.INFO)
+        sys.exit(serve(args.socket, args.max_jobs))
+    else:
+        argv = args.argv[1:] if args.argv[:1] == ['--'] else args.argv
+        sys.exit(submit(args.socket, argv))
@@ -17,23 +17,217 @@ ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
 OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 """
 
+import os
+import time
+import signal
+import json
 import logging
+import threading
+import traceback
 from datetime import datetime
+from hashlib import sha1, sha256, md5
 import re
 import subprocess
 
-class DeployException(object):
+class DeployException(Exception):
     pass
 
+class MigrationHandle(object):
+    """
+    Runs a DatabaseMigrator on a background thread so the caller can overlap
+    it with other deploy work, then collect the (status, stdout, stderr) tuple
+    with wait().
+    """
+    def __init__(self, migrator):
+        self.migrator = migrator
+        self.result = None
+        self.started = None
+        self.finished = None
+        self.thread = threading.Thread(target=self._run, name="db-migrator")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        self.started = time.time()
+        try:
+            self.result = self.migrator.run()
+        except Exception, ex:
+            logging.exception("Exception running db migrator")
+            self.result = (1, "", traceback.format_exc())
+        finally:
+            self.finished = time.time()
+
+    def done(self):
+        return not self.thread.is_alive()
+
+    def wait(self):
+        # Join in slices, a bare join() swallows KeyboardInterrupt on python 2
+        while self.thread.is_alive():
+            self.thread.join(0.5)
+        return self.result
+
+    def cancel(self):
+        self.migrator.cancel()
+
+class CompletedMigration(object):
+    """
+    Stand-in for a MigrationHandle when there is nothing to run.
+    """
+    def __init__(self, result):
+        self.result = result
+
+    def done(self):
+        return True
+
+    def wait(self):
+        return self.result
+
+    def cancel(self):
+        pass
+
 class DatabaseMigrator(object):
     REGISTERED_MIGRATORS = {}
+    DEFAULT_TIMEOUT = 600
+    POLL_INTERVAL = 0.2
+    # How long to wait for the output pipes to close once the migrator exits
+    READER_TIMEOUT = 5
+    # Deploys sharing a process (the daemon) would otherwise race on the
+    # state file and run makemigrations over the same tree at the same time
+    MIGRATION_LOCK = threading.Lock()
     
-    def __init__(self):
-        pass
+    def __init__(self, timeout=None, watch_paths=None, state_path=None):
+        self.timeout = timeout or self.DEFAULT_TIMEOUT
+        self.watch_paths = watch_paths
+        self.state_path = state_path
+        self.proc = None
+        self.cancelled = False
     
-    def run(self):
+    def get_argv(self):
         raise NotImplementedError("Must be implemented in subclass of DatabaseMigrator")
 
+    def get_watch_paths(self):
+        return self.watch_paths or []
+
+    def run(self):
+        with self.MIGRATION_LOCK:
+            source_hash = None
+            if self.state_path:
+                source_hash = self.compute_source_hash()
+                if source_hash and source_hash == self.read_last_hash():
+                    msg = "No model or migration changes since last successful run, skipping db migrations."
+                    logging.info(msg)
+                    return (0, msg, "")
+
+            (status, stdout, stderr) = self.run_command(self.get_argv())
+
+            if status == 0 and source_hash:
+                # The migrator may have written new migration files, so store the
+                # hash of the tree as it is after the run.
+                self.write_last_hash(self.compute_source_hash())
+            
+            return (status, stdout, stderr)
+
+    def start(self):
+        return MigrationHandle(self)
+
+    def cancel(self):
+        self.cancelled = True
+        if self.proc and self.proc.poll() is None:
+            logging.warn("Killing db migrator process %s" % self.proc.pid)
+            self.kill()
+
+    def kill(self):
+        # The migrator runs in a process group of its own, so this also gets
+        # any children it started, which would otherwise keep the pipes open
+        try:
+            os.killpg(self.proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    def compute_source_hash(self):
+        paths = []
+        for watch_path in self.get_watch_paths():
+            if os.path.isdir(watch_path):
+                for root, dirs, files in os.walk(watch_path):
+                    dirs.sort()
+                    for fname in sorted(files):
+                        if fname.endswith(".py"):
+                            paths.append(os.path.join(root, fname))
+            elif os.path.isfile(watch_path):
+                paths.append(watch_path)
+        
+        if not paths:
+            return None
+        
+        digest = sha1()
+        for path in sorted(paths):
+            digest.update(path)
+            with open(path, 'rb') as f:
+                digest.update(sha1(f.read()).digest())
+        return digest.hexdigest()
+
+    def read_last_hash(self):
+        try:
+            with open(self.state_path, 'r') as f:
+                return f.read().strip()
+        except IOError:
+            return None
+
+    def write_last_hash(self, source_hash):
+        state_dir = os.path.dirname(self.state_path)
+        if state_dir and not os.path.isdir(state_dir):
+            os.makedirs(state_dir)
+        tmp_path = "%s.%s.tmp" % (self.state_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write(source_hash)
+        os.rename(tmp_path, self.state_path)
+
+    def _start_reader(self, stream, lines, level):
+        def read():
+            for line in iter(stream.readline, ''):
+                lines.append(line)
+                logging.log(level, "db migrator: %s" % line.rstrip())
+            stream.close()
+        reader = threading.Thread(target=read)
+        reader.daemon = True
+        reader.start()
+        return reader
+
+    def run_command(self, argv):
+        if self.cancelled:
+            return (1, "", "Db migrator was cancelled before it started")
+
+        self.proc = subprocess.Popen(argv,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE,
+                                     preexec_fn=os.setsid)
+        stdout_lines = []
+        stderr_lines = []
+        readers = [self._start_reader(self.proc.stdout, stdout_lines, logging.INFO),
+                   self._start_reader(self.proc.stderr, stderr_lines, logging.WARNING)]
+        
+        deadline = time.time() + self.timeout
+        timed_out = False
+        while self.proc.poll() is None:
+            if time.time() > deadline:
+                timed_out = True
+                self.kill()
+                break
+            time.sleep(self.POLL_INTERVAL)
+        
+        self.proc.wait()
+        for reader in readers:
+            reader.join(self.READER_TIMEOUT)
+        
+        status = self.proc.returncode
+        stdout = "".join(stdout_lines)
+        stderr = "".join(stderr_lines)
+        if timed_out:
+            stderr += "Db migrator %s timed out after %s seconds.\n" % (" ".join(argv), self.timeout)
+            status = status or 1
+        
+        return (status, stdout, stderr)
+
     @classmethod
     def get_migrator(cls, name):
         if name in cls.REGISTERED_MIGRATORS:
@@ -46,31 +240,309 @@ class DatabaseMigrator(object):
         cls.REGISTERED_MIGRATORS[name] = migrator_cls
 
 class DjangoDatabaseMigrator(DatabaseMigrator):
-    def __init__(self):
-        super(DjangoDatabaseMigrator, self).__init__()
+    SKIP_DIRS = ['node_modules', 'static', 'dist', 'build']
+
+    def __init__(self, **kwargs):
+        super(DjangoDatabaseMigrator, self).__init__(**kwargs)
         
-    def run(self):
-        argv = ['python',
+    def get_argv(self):
+        return ['python',
                 'manage.py',
                 'makemigrations'
         ]
 
-        proc = subprocess.Popen(argv,
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE)
-        stdout, stderr = proc.communicate()
-        
-        proc.wait()
-        status = proc.returncode
+    def get_watch_paths(self):
+        if self.watch_paths:
+            return self.watch_paths
         
-        return (status, stdout, stderr)
+        # Any folder with a migrations package is a django app, watch its
+        # models module/package along with the migrations themselves.
+        watch_paths = []
+        for root, dirs, files in os.walk("."):
+            dirs[:] = [d for d in dirs if not d.startswith(".") and d not in self.SKIP_DIRS]
+            if 'migrations' in dirs:
+                watch_paths.append(os.path.join(root, 'migrations'))
+                for models_path in [os.path.join(root, 'models.py'), os.path.join(root, 'models')]:
+                    if os.path.exists(models_path):
+                        watch_paths.append(models_path)
+        return watch_paths
 
 DatabaseMigrator.register_migrator('django', DjangoDatabaseMigrator)
 
+class HookResult(object):
+    OK = 'ok'
+    FAILED = 'failed'
+    TIMED_OUT = 'timed out'
+    SKIPPED = 'skipped'
+
+    def __init__(self, name, status, duration=0.0, error=None):
+        self.name = name
+        self.status = status
+        self.duration = duration
+        self.error = error
+
+    def __repr__(self):
+        return "<HookResult %s: %s in %.2fs>" % (self.name, self.status, self.duration)
+
+class PreDeployHookRunner(object):
+    """
+    Runs pre-deploy hooks concurrently, each on its own thread with its own
+    timeout. A hook only waits on the hooks named in its depends-on list; a
+    hook whose dependency failed is skipped. Hooks that time out are
+    abandoned (and told to cancel() if they support it) so they can't hold
+    up the release.
+    """
+    DEFAULT_TIMEOUT = 300
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, hooks, deployer, default_timeout=None):
+        self.hooks = hooks
+        self.deployer = deployer
+        self.default_timeout = default_timeout or self.DEFAULT_TIMEOUT
+
+    def check_dependencies(self):
+        for hook_name, hook_details in self.hooks.items():
+            for dep in hook_details.get('depends-on', []):
+                if dep not in self.hooks:
+                    raise DeployException("Pre-deploy hook %s depends on unknown hook %s" % (hook_name, dep))
+        
+        placed = set()
+        remaining = set(self.hooks)
+        while remaining:
+            ready = set(h for h in remaining
+                        if set(self.hooks[h].get('depends-on', [])) <= placed)
+            if not ready:
+                raise DeployException("Pre-deploy hooks have circular dependencies: %s" % ", ".join(sorted(remaining)))
+            placed.update(ready)
+            remaining.difference_update(ready)
+
+    def _run_hook(self, hook_name, state):
+        hook_details = self.hooks[hook_name]
+        try:
+            try:
+                state['obj'] = hook_details['cls'](self.deployer)
+            except Exception, ex:
+                logging.exception("Problem instantiating hook class %s, skipping execution." % hook_details['cls'])
+                state['error'] = ex
+                return
+            
+            try:
+                state['obj'].run(hook_details['params'])
+            except Exception, ex:
+                logging.exception("Exception running hook %s" % hook_name)
+                state['error'] = ex
+        finally:
+            state['end'] = time.time()
+
+    def _start_hook(self, hook_name):
+        state = {'start': time.time()}
+        thread = threading.Thread(target=self._run_hook, args=(hook_name, state),
+                                  name="pre-deploy-hook-%s" % hook_name)
+        thread.daemon = True
+        thread.start()
+        return (thread, state)
+
+    def _finish_hook(self, hook_name, thread, state):
+        timeout = self.hooks[hook_name].get('timeout') or self.default_timeout
+        if thread.is_alive():
+            if time.time() < state['start'] + timeout:
+                return None
+            logging.error("Pre-deploy hook %s timed out after %s seconds, abandoning it." % (hook_name, timeout))
+            if hasattr(state.get('obj'), 'cancel'):
+                try:
+                    state['obj'].cancel()
+                except Exception:
+                    logging.exception("Problem cancelling hook %s" % hook_name)
+            return HookResult(hook_name, HookResult.TIMED_OUT, time.time() - state['start'])
+        
+        duration = state['end'] - state['start']
+        if 'error' in state:
+            return HookResult(hook_name, HookResult.FAILED, duration, state['error'])
+        return HookResult(hook_name, HookResult.OK, duration)
+
+    def run(self):
+        self.check_dependencies()
+        
+        results = {}
+        running = {}
+        pending = set(self.hooks)
+        while pending or running:
+            for hook_name in sorted(pending):
+                deps = self.hooks[hook_name].get('depends-on', [])
+                if not all(d in results for d in deps):
+                    continue
+                pending.remove(hook_name)
+                
+                failed_deps = [d for d in deps if results[d].status != HookResult.OK]
+                if failed_deps:
+                    logging.error("Skipping pre-deploy hook %s, dependencies did not succeed: %s" % (
+                        hook_name, ", ".join(failed_deps)))
+                    results[hook_name] = HookResult(hook_name, HookResult.SKIPPED)
+                else:
+                    running[hook_name] = self._start_hook(hook_name)
+            
+            if not running:
+                # Only skipped hooks were left to settle, go around again
+                continue
+            
+            for hook_name, (thread, state) in running.items():
+                thread.join(self.POLL_INTERVAL / len(running))
+                result = self._finish_hook(hook_name, thread, state)
+                if result:
+                    results[hook_name] = result
+                    del running[hook_name]
+        
+        for hook_name in sorted(results, key=lambda h: -results[h].duration):
+            logging.info("Pre-deploy hook %s: %s in %.2fs" % (hook_name, results[hook_name].status,
+                                                               results[hook_name].duration))
+        return results
+
+def file_sha256(path, blocksize=1 << 20):
+    digest = sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def file_digests(path, blocksize=1 << 20):
+    """
+    (md5, sha256, size) of a file, from one pass over it.
+    """
+    md5_digest = md5()
+    sha256_digest = sha256()
+    size = 0
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), ''):
+            md5_digest.update(block)
+            sha256_digest.update(block)
+            size += len(block)
+    return (md5_digest.hexdigest(), sha256_digest.hexdigest(), size)
+
+class FileHashIndex(object):
+    """
+    (md5, sha256, size) of files, reused while a file's mtime and size don't
+    change. Lives across deploys in the deploy daemon, so an unchanged static
+    tree isn't read again.
+    """
+    def __init__(self):
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, path, blocksize=1 << 20):
+        st = os.stat(path)
+        key = os.path.abspath(path)
+        stamp = (st.st_mtime, st.st_size)
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry and entry[0] == stamp:
+            return entry[1]
+        
+        digests = file_digests(path, blocksize)
+        with self.lock:
+            self.entries[key] = (stamp, digests)
+        return digests
+
+    def sha256(self, path):
+        return self.get(path)[1]
+
+class StaticDeployJournal(object):
+    """
+    Append-only record of the static keys uploaded for a release, so an
+    interrupted static deploy can be resumed without re-uploading (or even
+    re-checking in S3) what already made it. One file per release id:
+
+        {"release_id": ..., "stamp": ..., "blessed": ...}
+        <sha256> <size> <key>
+        ...
+        #complete
+    """
+    COMPLETE_MARKER = "#complete"
+
+    def __init__(self, path, release_id, stamp=None, blessed=False, entries=None, complete=False):
+        self.path = path
+        self.release_id = release_id
+        self.stamp = stamp
+        self.blessed = blessed
+        self.entries = entries or {}
+        self.complete = complete
+        self.lock = threading.Lock()
+        self.f = None
+
+    @classmethod
+    def get_path(cls, journal_dir, release_id):
+        return os.path.join(journal_dir, "%s.journal" % release_id)
+
+    @classmethod
+    def load(cls, path):
+        entries = {}
+        complete = False
+        with open(path, 'r') as f:
+            header = json.loads(f.readline())
+            for line in f:
+                line = line.rstrip("\n")
+                if line == cls.COMPLETE_MARKER:
+                    complete = True
+                elif line.count(" ") >= 2:
+                    # A line cut short by a crash has no key yet, ignore it
+                    digest, size, key = line.split(" ", 2)
+                    entries[key] = (digest, int(size))
+        return cls(path, header['release_id'], header.get('stamp'), header.get('blessed', False),
+                   entries, complete)
+
+    @classmethod
+    def open(cls, journal_dir, release_id, stamp, blessed, reset=False):
+        path = cls.get_path(journal_dir, release_id)
+        if reset and os.path.exists(path):
+            os.remove(path)
+        if os.path.exists(path):
+            journal = cls.load(path)
+        else:
+            if not os.path.isdir(journal_dir):
+                os.makedirs(journal_dir)
+            with open(path, 'w') as f:
+                f.write(json.dumps({'release_id': release_id, 'stamp': stamp, 'blessed': blessed}) + "\n")
+            journal = cls(path, release_id, stamp, blessed)
+        journal.f = open(path, 'a')
+        return journal
+
+    @classmethod
+    def find_incomplete(cls, journal_dir):
+        if not os.path.isdir(journal_dir):
+            return None
+        paths = [os.path.join(journal_dir, p) for p in os.listdir(journal_dir) if p.endswith(".journal")]
+        for path in sorted(paths, key=os.path.getmtime, reverse=True):
+            journal = cls.load(path)
+            if not journal.complete:
+                return journal
+        return None
+
+    def is_done(self, key, digest):
+        return key in self.entries and self.entries[key][0] == digest
+
+    def record(self, key, digest, size):
+        with self.lock:
+            self.entries[key] = (digest, size)
+            self.f.write("%s %s %s\n" % (digest, size, key))
+            self.f.flush()
+
+    def mark_complete(self):
+        with self.lock:
+            self.complete = True
+            self.f.write(self.COMPLETE_MARKER + "\n")
+            self.f.flush()
+
+    def close(self):
+        if self.f:
+            self.f.close()
+            self.f = None
+
 class DeployLib(object):
-    def __init__(self, product_prefix=None, db_migrator=None):
+    def __init__(self, product_prefix=None, db_migrator=None, migrator_options=None, git_cache=None):
         self.product_prefix = product_prefix
+        # Shared across deploys by the daemon, see intuit_git_info
+        self.git_cache = git_cache
         self.db_migrator_name = db_migrator
+        self.migrator_options = migrator_options or {}
         if self.db_migrator_name:
             self.migrator_cls = DatabaseMigrator.get_migrator(self.db_migrator_name)
             self.no_migrator = False
@@ -88,14 +560,17 @@ class DeployLib(object):
                 raise DeployException("Could not determine product to deploy. Please either specify a --product argument to this script or a PRODUCT file in the repo root.")
     
     def run_db_migrations(self):
+        return self.start_db_migrations().wait()
+
+    def start_db_migrations(self):
         if self.no_migrator:
-            return (0, "No db migrator specified.", "")
+            return CompletedMigration((0, "No db migrator specified.", ""))
         else:
             if self.migrator_cls:
-                migrator_inst = self.migrator_cls()
-                return migrator_inst.run()
+                migrator_inst = self.migrator_cls(**self.migrator_options)
+                return migrator_inst.start()
             else:
-                return (1, "", "Could not find db migrator [%s]" % self.db_migrator_name)
+                return CompletedMigration((1, "", "Could not find db migrator [%s]" % self.db_migrator_name))
     
     def intuit_git_commit_trunc_hash(self):
         argv = ['git',
@@ -123,9 +598,45 @@ class DeployLib(object):
             branch = branch[len('refs/heads/'):]
         return branch
 
+    def get_git_state(self):
+        """
+        HEAD plus the stat of every file that changes when HEAD moves, or None
+        outside a plain .git directory.
+        """
+        try:
+            with open(os.path.join('.git', 'HEAD'), 'r') as f:
+                head = f.read().strip()
+        except IOError:
+            return None
+        
+        paths = [os.path.join('.git', 'HEAD'), os.path.join('.git', 'packed-refs')]
+        if head.startswith('ref: '):
+            paths.append(os.path.join('.git', head[len('ref: '):]))
+        state = [os.path.abspath('.'), head]
+        for path in paths:
+            try:
+                st = os.stat(path)
+                state.append((path, st.st_mtime, st.st_size))
+            except OSError:
+                state.append((path, None))
+        return tuple(state)
+
+    def intuit_git_info(self):
+        """
+        (branch, truncated commit hash), only asking git again when a
+        checkout or commit has touched .git since the last time.
+        """
+        state = self.get_git_state() if self.git_cache is not None else None
+        if state is not None and self.git_cache.get('state') == state:
+            return self.git_cache['info']
+        
+        info = (self.intuit_git_branch(), self.intuit_git_commit_trunc_hash())
+        if state is not None:
+            self.git_cache.update(state=state, info=info)
+        return info
+
     def gen_release_id(self, stack_name, stamp, is_blessed):
-        branch = self.intuit_git_branch()
-        trunc_hash = self.intuit_git_commit_trunc_hash()
+        (branch, trunc_hash) = self.intuit_git_info()
         pkg_name = None
         pkg_ver = None
 
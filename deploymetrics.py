@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+"""
+Per-operation accounting for every AWS call a deploy makes, and trace spans
+for the deploy as a whole.
+
+ApiMetrics is a ClientPool observer: it hooks botocore's events on each
+client and records calls, errors, retries, payload bytes and a latency
+histogram per service and operation. At the end of a run they're written out
+as JSON and, optionally, as a Prometheus textfile for node_exporter's
+textfile collector.
+
+Tracer records nested spans around deploy phases (and, as an observer, every
+AWS call) and writes them as a Chrome trace-event file that chrome://tracing
+or ui.perfetto.dev can open.
+"""
+
+import os
+import time
+import json
+import bisect
+import logging
+import threading
+from functools import wraps
+from contextlib import contextmanager
+
+from deployaws import ClientObserver, get_payload_size
+
+# Upper bounds in seconds, Prometheus style
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class LatencyHistogram(object):
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # One more slot for anything over the last bound
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def cumulative(self):
+        """
+        (upper bound, observations <= bound) pairs, ending with +Inf.
+        """
+        total = 0
+        result = []
+        for bound, count in zip(list(self.buckets) + [float('inf')], self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 6),
+            'max': round(self.max, 6),
+            'buckets': dict(("+Inf" if bound == float('inf') else repr(bound), count)
+                            for bound, count in self.cumulative()),
+        }
+
+class OperationStats(object):
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.latency = LatencyHistogram()
+
+    def to_dict(self):
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'retries': self.retries,
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received,
+            'latency_seconds': self.latency.to_dict(),
+        }
+
+class ApiMetrics(ClientObserver):
+    """
+    Latency runs from before-call to after-call, so it includes botocore's
+    own retries. Register it after a RateLimiter so time spent waiting for
+    a client-side rate limit isn't counted as latency.
+    """
+    EVENTS = (
+        ('before-parameter-build.*.*', 'before_parameter_build'),
+        ('before-call.*.*', 'before_call'),
+        ('after-call.*.*', 'after_call'),
+        ('after-call-error.*.*', 'after_call_error'),
+    )
+
+    def __init__(self):
+        self.stats = {}
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def get_stats(self, context):
+        key = (context.get('metrics-service'), context.get('metrics-operation'))
+        stats = self.stats.get(key)
+        if stats is None:
+            stats = self.stats.setdefault(key, OperationStats())
+        return stats
+
+    def before_parameter_build(self, params, model, context, **kwargs):
+        context['metrics-service'] = model.service_model.service_name
+        context['metrics-operation'] = model.name
+        context['metrics-bytes'] = get_payload_size(params)
+
+    def before_call(self, context, **kwargs):
+        context['metrics-start'] = time.time()
+
+    def _finish(self, context, error, retries=0, bytes_received=0):
+        start = context.get('metrics-start')
+        with self.lock:
+            stats = self.get_stats(context)
+            stats.calls += 1
+            stats.retries += retries
+            stats.bytes_sent += context.get('metrics-bytes', 0)
+            stats.bytes_received += bytes_received
+            if error:
+                stats.errors += 1
+            if start is not None:
+                stats.latency.observe(time.time() - start)
+
+    def after_call(self, http_response, parsed, context, **kwargs):
+        retries = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+        try:
+            bytes_received = int(http_response.headers.get('content-length', 0))
+        except (AttributeError, TypeError, ValueError):
+            bytes_received = 0
+        self._finish(context, http_response.status_code >= 300, retries, bytes_received)
+
+    def after_call_error(self, context, **kwargs):
+        self._finish(context, True)
+
+    def to_dict(self):
+        with self.lock:
+            operations = [dict(stats.to_dict(), service=service_name, operation=operation)
+                          for (service_name, operation), stats in sorted(self.stats.items())]
+        return {
+            'started': self.started,
+            'elapsed': round(time.time() - self.started, 3),
+            'operations': operations,
+        }
+
+    def write_json(self, path, extra=None):
+        data = self.to_dict()
+        data.update(extra or {})
+        write_atomic(path, json.dumps(data, indent=1, sort_keys=True))
+
+    def write_prometheus(self, path, labels=None):
+        """
+        Writes a textfile collector file. Written to a temp file and renamed
+        so node_exporter never reads half a file.
+        """
+        labels = labels or {}
+        counters = [
+            ('calls', 'aws_deploy_api_calls_total', 'AWS API calls made by the deploy.'),
+            ('errors', 'aws_deploy_api_errors_total', 'AWS API calls that failed.'),
+            ('retries', 'aws_deploy_api_retries_total', 'Retries botocore made for AWS API calls.'),
+            ('bytes_sent', 'aws_deploy_api_sent_bytes_total', 'Request payload bytes sent to AWS.'),
+            ('bytes_received', 'aws_deploy_api_received_bytes_total', 'Response bytes received from AWS.'),
+        ]
+        with self.lock:
+            stats = sorted(self.stats.items())
+
+        lines = []
+        for attr, name, help_text in counters:
+            lines.append("# HELP %s %s" % (name, help_text))
+            lines.append("# TYPE %s counter" % name)
+            for (service_name, operation), op_stats in stats:
+                lines.append("%s{%s} %s" % (name, format_labels(labels, service_name, operation),
+                                            getattr(op_stats, attr)))
+
+        name = 'aws_deploy_api_latency_seconds'
+        lines.append("# HELP %s Latency of AWS API calls, including retries." % name)
+        lines.append("# TYPE %s histogram" % name)
+        for (service_name, operation), op_stats in stats:
+            for bound, count in op_stats.latency.cumulative():
+                le = "+Inf" if bound == float('inf') else repr(bound)
+                lines.append("%s_bucket{%s} %s" % (name, format_labels(labels, service_name, operation, le=le), count))
+            lines.append("%s_sum{%s} %s" % (name, format_labels(labels, service_name, operation), op_stats.latency.sum))
+            lines.append("%s_count{%s} %s" % (name, format_labels(labels, service_name, operation), op_stats.latency.count))
+        write_atomic(path, "\n".join(lines) + "\n")
+
+    def log_summary(self, limit=10):
+        with self.lock:
+            stats = sorted(self.stats.items(), key=lambda s: -s[1].latency.sum)
+        for (service_name, operation), op_stats in stats[:limit]:
+            logging.info("AWS %s.%s: %s calls, %.2fs total, %.3fs avg, %.3fs max, %s retries, %s errors" % (
+                service_name, operation, op_stats.calls, op_stats.latency.sum,
+                op_stats.latency.sum / max(op_stats.latency.count, 1), op_stats.latency.max,
+                op_stats.retries, op_stats.errors))
+
+def format_labels(labels, service_name, operation, **extra):
+    labels = dict(labels, service=service_name, operation=operation, **extra)
+    return ",".join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                    for k, v in sorted(labels.items()))
+
+def write_atomic(path, content):
+    dirname = os.path.dirname(path)
+    if dirname and not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    tmp_path = "%s.%s.tmp" % (path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        f.write(content)
+    os.rename(tmp_path, path)
+
+class Tracer(ClientObserver):
+    """
+    Collects spans as Chrome trace "complete" events. Each thread gets its own
+    row, so work on the upload pools shows up overlapping the main thread.
+    A disabled tracer records nothing.
+    """
+    EVENTS = (
+        ('before-call.*.*', 'before_call'),
+        ('after-call.*.*', 'after_call'),
+        ('after-call-error.*.*', 'after_call'),
+    )
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.events = []
+        self.threads = {}
+        self.origin = time.time()
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+
+    def get_tid(self, thread=None):
+        thread = thread or threading.current_thread()
+        # Idents get reused once a thread exits, the name tells them apart
+        key = (thread.ident, thread.name)
+        with self.lock:
+            if key not in self.threads:
+                self.threads[key] = len(self.threads) + 1
+            return self.threads[key]
+
+    @contextmanager
+    def span(self, name, category='deploy', **args):
+        if not self.enabled:
+            yield
+            return
+        start = time.time()
+        try:
+            yield
+        except Exception, ex:
+            args['error'] = str(ex)
+            raise
+        finally:
+            self.add_span(name, start, time.time(), category, args=args)
+
+    def add_span(self, name, start, end, category='deploy', thread=None, args=None):
+        if not self.enabled:
+            return
+        event = {
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': int((start - self.origin) * 1000000),
+            'dur': int((end - start) * 1000000),
+            'pid': self.pid,
+            'tid': self.get_tid(thread),
+        }
+        if args:
+            event['args'] = args
+        with self.lock:
+            self.events.append(event)
+
+    def register(self, client):
+        if self.enabled:
+            super(Tracer, self).register(client)
+
+    def unregister(self, client):
+        if self.enabled:
+            super(Tracer, self).unregister(client)
+
+    def before_call(self, model, context, **kwargs):
+        context['trace-start'] = time.time()
+        context['trace-name'] = "%s.%s" % (model.service_model.service_name, model.name)
+
+    def after_call(self, context, **kwargs):
+        if 'trace-start' in context:
+            self.add_span(context['trace-name'], context['trace-start'], time.time(), 'aws')
+
+    def write(self, path):
+        with self.lock:
+            events = list(self.events)
+            threads = dict(self.threads)
+        metadata = [{'name': 'process_name', 'ph': 'M', 'pid': self.pid, 'tid': 0,
+                     'args': {'name': 'deploy'}}]
+        for (_, thread_name), tid in sorted(threads.items(), key=lambda t: t[1]):
+            metadata.append({'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': tid,
+                             'args': {'name': thread_name}})
+        write_atomic(path, json.dumps({'traceEvents': metadata + sorted(events, key=lambda e: e['ts']),
+                                       'displayTimeUnit': 'ms'}))
+
+def traced(name, category='deploy'):
+    """
+    Wraps a method of anything with a tracer attribute in a span.
+    """
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.tracer.span(name, category):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
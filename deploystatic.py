@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+Content-addressed layout for static releases.
+
+Instead of a full copy of the static tree under every release prefix, assets
+are stored once in a shared pool under content-hashed names:
+
+    <static-prefix>/<pool-dir>/css/site.3f2a9c0d1b7e.css
+
+and each release only gets the files that must keep their names (HTML entry
+points by default) plus a Django-style manifest mapping each
+original name to its pool name. References between files (CSS url()/@import,
+HTML src/href) are rewritten to point at the pooled names, so an unchanged
+asset costs nothing in a new release and can be cached forever.
+"""
+
+import os
+import re
+import json
+import posixpath
+from fnmatch import fnmatch
+from hashlib import md5, sha256
+
+from deploylib import file_digests
+
+MANIFEST_VERSION = "1.1"
+
+CSS_URL_RE = re.compile(r"""(url\(\s*(['"]?))([^'")]+)(\2\s*\))""")
+CSS_IMPORT_RE = re.compile(r"""(@import\s+(['"]))([^'"]+)(\2)""")
+HTML_REF_RE = re.compile(r"""((?:src|href)\s*=\s*(['"]))([^'"]+)(\2)""", re.IGNORECASE)
+
+class StaticAsset(object):
+    def __init__(self, path, rel_path):
+        self.path = path
+        self.rel_path = rel_path
+        # Only set when references inside the file were rewritten
+        self.content = None
+        self.hashed_rel_path = None
+        self.digest = None
+        self.sha256 = None
+        self.size = None
+
+    def read(self):
+        if self.content is not None:
+            return self.content
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+class ContentAddressedLayout(object):
+    def __init__(self, src_root, static_prefix=None, pool_dir='_pool', stable_names=None, hash_index=None):
+        self.src_root = src_root
+        self.static_prefix = static_prefix
+        self.pool_dir = pool_dir
+        self.stable_names = stable_names or ['*.html']
+        # Optional deploylib.FileHashIndex for files sent as they are
+        self.hash_index = hash_index
+
+    def get_rel_path(self, path):
+        return os.path.relpath(path, self.src_root).replace(os.path.sep, '/')
+
+    def get_pool_prefix(self):
+        return "/".join([p for p in [self.static_prefix, self.pool_dir] if p])
+
+    def get_pool_key(self, asset):
+        return "/".join([self.get_pool_prefix(), asset.hashed_rel_path])
+
+    def get_path_pattern(self):
+        return "/%s/*" % self.get_pool_prefix()
+
+    def is_stable(self, rel_path):
+        return any(fnmatch(posixpath.basename(rel_path), pattern) for pattern in self.stable_names)
+
+    def hash_asset(self, asset):
+        # Only rewritten assets are kept in memory, the rest are read in blocks
+        if asset.content is None:
+            get_digests = self.hash_index.get if self.hash_index is not None else file_digests
+            (asset.digest, asset.sha256, asset.size) = get_digests(asset.path)
+            return
+        asset.digest = md5(asset.content).hexdigest()
+        asset.sha256 = sha256(asset.content).hexdigest()
+        asset.size = len(asset.content)
+
+    def get_hashed_name(self, asset):
+        root, ext = posixpath.splitext(asset.rel_path)
+        return "%s.%s%s" % (root, asset.digest[:12], ext)
+
+    def resolve_ref(self, ref, from_rel_path):
+        """
+        Returns the rel path (within the static tree) a reference points at,
+        or None for anything external or not resolvable.
+        """
+        if ref.startswith(('data:', '#', '//')) or '://' in ref:
+            return None
+        ref = ref.split('#', 1)[0].split('?', 1)[0]
+        if not ref:
+            return None
+        if ref.startswith('/'):
+            # Absolute paths are relative to the distribution root
+            if self.static_prefix:
+                root = '/%s/' % self.static_prefix
+                if not ref.startswith(root):
+                    return None
+                return posixpath.normpath(ref[len(root):])
+            return posixpath.normpath(ref[1:])
+        return posixpath.normpath(posixpath.join(posixpath.dirname(from_rel_path), ref))
+
+    def get_refs(self, asset):
+        patterns = self.get_ref_patterns(asset.rel_path)
+        if not patterns:
+            return []
+        content = asset.read()
+        refs = []
+        for pattern in patterns:
+            for m in pattern.finditer(content):
+                refs.append(m.group(3))
+        return refs
+
+    def get_ref_patterns(self, rel_path):
+        ext = posixpath.splitext(rel_path)[1].lower()
+        if ext == '.css':
+            return [CSS_URL_RE, CSS_IMPORT_RE]
+        elif ext in ('.html', '.htm'):
+            return [HTML_REF_RE]
+        return []
+
+    def rewrite(self, asset, served_dir, assets_by_rel):
+        """
+        Rewrite references in asset to pooled names, relative to served_dir
+        (where the asset itself will be served from, relative to the static
+        prefix).
+        """
+        patterns = self.get_ref_patterns(asset.rel_path)
+        if not patterns:
+            return
+
+        def replace(m):
+            target = assets_by_rel.get(self.resolve_ref(m.group(3), asset.rel_path))
+            if target is None or target.hashed_rel_path is None:
+                return m.group(0)
+            new_ref = posixpath.relpath(posixpath.join(self.pool_dir, target.hashed_rel_path), served_dir or '.')
+            # Keep any query string/fragment the reference had
+            suffix = m.group(3)[len(m.group(3).split('#', 1)[0].split('?', 1)[0]):]
+            return m.group(1) + new_ref + suffix + m.group(4)
+
+        original = asset.read()
+        content = original
+        for pattern in patterns:
+            content = pattern.sub(replace, content)
+        if content != original:
+            asset.content = content
+
+    def plan(self, paths):
+        """
+        Works out pool names for every asset under src_root. Returns
+        (pooled assets, stable assets, manifest dict).
+        """
+        assets = [StaticAsset(p, self.get_rel_path(p)) for p in paths]
+        assets_by_rel = dict((a.rel_path, a) for a in assets)
+        stable = [a for a in assets if self.is_stable(a.rel_path)]
+        pooled = [a for a in assets if not self.is_stable(a.rel_path)]
+
+        # An asset's hash depends on the rewritten references inside it, so
+        # hash its dependencies first. Anything caught in a cycle is hashed
+        # with whatever references could be rewritten by then.
+        deps = {}
+        for asset in pooled:
+            deps[asset.rel_path] = set(r for r in (self.resolve_ref(ref, asset.rel_path) for ref in self.get_refs(asset))
+                                       if r in assets_by_rel and r != asset.rel_path
+                                       and not self.is_stable(r))
+        remaining = dict((a.rel_path, a) for a in pooled)
+        while remaining:
+            ready = [a for rel, a in remaining.items() if not (deps[rel] & set(remaining))]
+            if not ready:
+                ready = remaining.values()
+            for asset in sorted(ready, key=lambda a: a.rel_path):
+                self.rewrite(asset, posixpath.join(self.pool_dir, posixpath.dirname(asset.rel_path)), assets_by_rel)
+                self.hash_asset(asset)
+                asset.hashed_rel_path = self.get_hashed_name(asset)
+                del remaining[asset.rel_path]
+
+        for asset in stable:
+            self.rewrite(asset, posixpath.dirname(asset.rel_path), assets_by_rel)
+            self.hash_asset(asset)
+
+        manifest = {
+            'version': MANIFEST_VERSION,
+            'paths': dict((a.rel_path, posixpath.join(self.pool_dir, a.hashed_rel_path)) for a in pooled),
+            'layout': 'content-addressed',
+        }
+        return (pooled, stable, manifest)
+
+def dump_manifest(manifest):
+    return json.dumps(manifest, indent=1, sort_keys=True)
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+Run from the repository root with: python -m unittest discover tests
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from hashlib import md5
+from multiprocessing.pool import ThreadPool
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+import boto3
+from botocore.config import Config
+
+from deployaws import upload_hashed
+
+class StubS3Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubS3Handler)
+        self.objects = {}
+        self.lock = threading.Lock()
+
+class StubS3Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_PUT(self):
+        if self.headers.get('Expect', '').lower() == '100-continue':
+            self.wfile.write("HTTP/1.1 100 Continue\r\n\r\n")
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        with self.server.lock:
+            self.server.objects[self.path] = body
+        self.send_response(200)
+        self.send_header('ETag', '"%s"' % md5(body).hexdigest())
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+class UploadHashedTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StubS3Server()
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp_dir)
+
+    def make_client(self):
+        return boto3.client('s3', region_name='us-east-1', aws_access_key_id='x', aws_secret_access_key='y',
+                            endpoint_url='http://127.0.0.1:%s' % self.server.server_address[1],
+                            config=Config(s3={'addressing_style': 'path'}, retries={'max_attempts': 0},
+                                          read_timeout=10))
+
+    def test_every_target_gets_the_whole_file(self):
+        path = os.path.join(self.tmp_dir, 'app.js')
+        data = os.urandom(3 * 1024 * 1024)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+        targets = [(self.make_client(), 'primary'), (self.make_client(), 'replica')]
+        pool = ThreadPool(2)
+        try:
+            for _ in range(4):
+                results = upload_hashed(targets, 'static/app.js', filename=path, pool=pool)
+                self.assertEqual([r.bucket_name for r in results], ['primary', 'replica'])
+                self.assertEqual(self.server.objects['/primary/static/app.js'], data)
+                self.assertEqual(self.server.objects['/replica/static/app.js'], data)
+                self.server.objects.clear()
+        finally:
+            pool.terminate()
+
+if __name__ == '__main__':
+    unittest.main()
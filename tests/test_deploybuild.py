@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+Run from the repository root with: python -m unittest discover tests
+"""
+
+import os
+import random
+import shutil
+import tarfile
+import tempfile
+import unittest
+from StringIO import StringIO
+
+import deploybuild
+from deploybuild import write_release_archive
+
+class ChunkedArchiveTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.src_dir = tempfile.mkdtemp()
+        os.chdir(self.src_dir)
+        self.chunk_sizes = (deploybuild.CHUNK_MIN_SIZE, deploybuild.CHUNK_MAX_SIZE)
+        (deploybuild.CHUNK_MIN_SIZE, deploybuild.CHUNK_MAX_SIZE) = (64 * 1024, 256 * 1024)
+
+        rand = random.Random(0)
+        self.files = []
+        for i in range(200):
+            path = os.path.join('myapp', 'module%03d.py' % i)
+            if not os.path.isdir('myapp'):
+                os.makedirs('myapp')
+            with open(path, 'wb') as f:
+                f.write("".join(chr(rand.randint(32, 126)) for _ in range(8 * 1024)))
+            self.files.append(path)
+
+    def tearDown(self):
+        (deploybuild.CHUNK_MIN_SIZE, deploybuild.CHUNK_MAX_SIZE) = self.chunk_sizes
+        os.chdir(self.cwd)
+        shutil.rmtree(self.src_dir)
+
+    def build(self, version):
+        fullname = 'myapp-%s' % version
+        metadata = {'PKG-INFO': "Metadata-Version: 1.0\nName: myapp\nVersion: %s\n" % version,
+                    'myapp.egg-info/PKG-INFO': "Metadata-Version: 1.0\nName: myapp\nVersion: %s\n" % version,
+                    'myapp.egg-info/SOURCES.txt': "\n".join(self.files)}
+        archive = StringIO()
+        chunks = write_release_archive(archive, fullname, self.files, metadata, workers=2,
+                                       chunked=True, base_dir='myapp')
+        return (archive.getvalue(), chunks)
+
+    def test_versions_share_chunks(self):
+        (data, chunks) = self.build('1.0.0+20170714t024000.01b15a2')
+        (_, next_chunks) = self.build('1.0.1+20170715t101500.9c3e7d0')
+
+        self.assertTrue(len(chunks) > 2)
+        self.assertEqual(sum(c['size'] for c in chunks), len(data))
+        # Only the metadata chunk at the end differs
+        self.assertEqual([c['sha256'] for c in chunks[:-1]], [c['sha256'] for c in next_chunks[:-1]])
+        self.assertNotEqual(chunks[-1]['sha256'], next_chunks[-1]['sha256'])
+
+        names = tarfile.open(fileobj=StringIO(data), mode='r:gz').getnames()
+        self.assertEqual(names[-4:], ['myapp/PKG-INFO', 'myapp/myapp.egg-info', 'myapp/myapp.egg-info/PKG-INFO',
+                                      'myapp/myapp.egg-info/SOURCES.txt'])
+        self.assertTrue(all(name.split('/')[0] == 'myapp' for name in names))
+
+if __name__ == '__main__':
+    unittest.main()